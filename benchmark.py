@@ -0,0 +1,463 @@
+'''Benchmarks for pyorg
+
+usage: python benchmark.py [name ...]
+
+Runs every benchmark when no name is given.
+'''
+import asyncio
+import json
+import linecache
+import os
+import random
+import subprocess
+import sys
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from time import monotonic, sleep
+from timeit import repeat
+
+import pyorg.org
+from pyorg.org import Org, LazyOrg, TerminalNode, Text, Limits, iter_tables
+from pyorg.org import org_to_html, org_to_html_many, Parser, extract_links
+from pyorg.diff import diff
+from pyorg.watch import Site
+
+
+def best_of(func, number=1, repeat_=5):
+    '''returns the best time of one call to func in seconds'''
+    return min(repeat(func, number=number, repeat=repeat_)) / number
+
+
+def report(name, seconds, size=None, unit='B'):
+    line = '{:<48} {:>10.2f} ms'.format(name, seconds * 1000)
+    if size:
+        line += '  {:>10.2f} M{}/s'.format(size / seconds / 1e6, unit)
+    print(line)
+
+
+def traced(func):
+    '''returns (result, peak traced bytes) of calling func'''
+    tracemalloc.start()
+    try:
+        result = func()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def make_document(sections, line='paragraph text with some words in it'):
+    '''returns a synthetic org document with the given number of sections'''
+    parts = []
+    for i in range(sections):
+        parts.append('''* Heading {0}
+{1}
+{1} *bold* and /italic/ and =code=
+** Sub heading {0}
+- item [[http://example.com/{0}][link {0}]]
+- item [[picture{0}.png]]
+| a {0} | b | c |
+| 1 | 2 | 3 |
+
+#+BEGIN_SRC python
+if a < b and b > c: pass
+#+END_SRC
+'''.format(i, line))
+    return ''.join(parts)
+
+
+def bench_escape():
+    '''render cost of escaping &<>"' on a large document'''
+    plain = make_document(2000)
+    special = make_document(2000, line='a < b && "c" > \'d\' & <e>')
+    escape = pyorg.org.escape
+    for label, text in (('plain', plain), ('special', special)):
+        o = Org(text)
+        pyorg.org.escape = lambda value: value
+        try:
+            base = best_of(o.html)
+        finally:
+            pyorg.org.escape = escape
+        escaped = best_of(o.html)
+        report('render {} without escaping'.format(label), base, len(text))
+        report('render {} with escaping'.format(label), escaped, len(text))
+        print('{:<48} {:>10.1f} %'.format(
+            'escaping overhead', (escaped / base - 1) * 100))
+
+
+def bench_inline_registry():
+    '''inline parse cost as unused constructs are registered'''
+    lines = make_document(2000).splitlines()
+    parse = lambda: [Text(line) for line in lines]
+    original = TerminalNode.inline_syntax
+    size = sum(len(line) for line in lines)
+    try:
+        for extra in (0, 4, 16, 64):
+            registry = original.copy()
+            for i in range(extra):
+                char = chr(0x2460 + i)
+                registry.register('extra{}'.format(i),
+                                  '{0}(?P<text>[^{0}]+){0}'.format(char),
+                                  char, Text)
+            TerminalNode.inline_syntax = registry
+            report('inline parse, {} extra constructs'.format(extra),
+                   best_of(parse), size)
+    finally:
+        TerminalNode.inline_syntax = original
+
+
+def make_report(sections):
+    '''returns a synthetic generated report repeating the same markup'''
+    section = '''* Daily report
+** Status
+- *result*: =OK=
+- checked by [[http://example.com/ci][ci]]
+| /host/ | *status* | =uptime= |
+| web | OK | 99.9 |
+| db | OK | 99.9 |
+
+~nothing to report~ in _this_ section
+'''
+    return section * sections
+
+
+def bench_intern():
+    '''parse time and memory of a repetitive document with interning'''
+    text = make_report(5000)
+    for intern in (False, True):
+        label = 'intern' if intern else 'no intern'
+        report('parse report, {}'.format(label),
+               best_of(lambda: Org(text, intern=intern)), len(text))
+        _, peak = traced(lambda: Org(text, intern=intern))
+        print('{:<48} {:>10.2f} MB'.format(
+            'peak memory, {}'.format(label), peak / 1e6))
+
+
+def bench_plain():
+    '''parse time of prose-heavy input with and without the plain-text fast path'''
+    paragraph = '''Most lines of a prose document carry no inline markup at all,
+they are just sentences written one after another, wrapped at a
+fixed column, and separated by blank lines between the paragraphs.
+Only now and then a line has a *bold* word or a [[http://example.com][link]].
+
+'''
+    text = paragraph * 10000
+    lines = [line for line in text.splitlines()
+             if not TerminalNode.inline_syntax.has_markup(line)]
+    parse = lambda: [Text(line) for line in lines]
+    registry = TerminalNode.inline_syntax
+    report('parse prose', best_of(lambda: Org(text)), len(text))
+    size = sum(len(line) for line in lines)
+    report('inline parse plain lines, fast path', best_of(parse), size)
+    registry.has_markup = lambda value: True
+    try:
+        report('inline parse plain lines, delimiter table only',
+               best_of(parse), size)
+        registry.candidates = lambda value: registry.syntaxes
+        report('inline parse plain lines, every construct tried',
+               best_of(parse), size)
+    finally:
+        del registry.has_markup
+        del registry.candidates
+
+
+def fuzz_text(size, alphabet='ab */_+=~[]:|-#\n', seed=0):
+    '''returns random text over the characters the grammar cares about'''
+    rand = random.Random(seed)
+    return ''.join(rand.choice(alphabet) for _ in range(size))
+
+
+ADVERSARIAL = {
+    'table row without closing bar': lambda n: '|' + 'a|' * (n // 2) + 'x',
+    'list item of blanks': lambda n: '- ' + ' ' * n + 'x',
+    'unclosed links': lambda n: '[[http://' * (n // 9),
+    'chained emphasis': lambda n: 'a*b ' * (n // 4),
+    'unclosed emphasis': lambda n: '*/_+=~' * (n // 6),
+    'random line': lambda n: fuzz_text(n, alphabet='ab */_+=~[]:|-'),
+    'random lines': fuzz_text,
+}
+
+
+def bench_adversarial():
+    '''parse time of crafted input; ns/B stays flat when parsing is linear'''
+    limits = Limits(max_line_length=None, max_work=None)
+    for name, make in sorted(ADVERSARIAL.items()):
+        for size in (10000, 20000, 40000, 80000):
+            text = make(size)
+            seconds = best_of(lambda: Org(text, limits=limits), repeat_=3)
+            print('{:<36} {:>7} B {:>10.2f} ms {:>8.1f} ns/B'.format(
+                name, len(text), seconds * 1000, seconds / len(text) * 1e9))
+
+
+def bench_watch():
+    '''rebuild latency of one edited section as the site grows'''
+    for files in (10, 100, 1000):
+        with TemporaryDirectory() as src, TemporaryDirectory() as dest:
+            for i in range(files):
+                with open(os.path.join(src, '{}.org'.format(i)), 'w') as f:
+                    f.write(make_document(20))
+            site = Site(src, dest)
+            try:
+                start = monotonic()
+                site.rebuild(site.poll())
+                full = monotonic() - start
+                path = os.path.join(src, '0.org')
+                times = []
+                for i in range(5):
+                    with open(path) as f:
+                        text = f.read()
+                    with open(path, 'w') as f:
+                        f.write(text.replace('Heading 7', 'Heading 7.'))
+                    start = monotonic()
+                    site.rebuild(site.poll())
+                    times.append(monotonic() - start)
+            finally:
+                site.close()
+        report('full build, {} files'.format(files), full)
+        report('rebuild after an edit, {} files'.format(files), min(times))
+
+
+def bench_tables():
+    '''loading a 100k row table as nodes and as columns'''
+    rows = ['| name | count | ratio |', '|------+-------+-------|']
+    rows.extend('| item{0} | {0} | {1} |'.format(i, i / 7)
+                for i in range(100000))
+    text = '\n'.join(rows)
+    for label, load in (('node tree', lambda: Org(text)),
+                        ('columns', lambda: list(iter_tables(text)))):
+        report('load table, {}'.format(label),
+               best_of(load, repeat_=3), len(text))
+        _, peak = traced(load)
+        print('{:<48} {:>10.2f} MB'.format(
+            'peak memory, {}'.format(label), peak / 1e6))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def load(path, text, connections, requests, window):
+    '''sends requests over connections pipelining up to window each,
+    returns the latency of every request'''
+    latencies = []
+
+    async def client(count):
+        reader, writer = await asyncio.open_unix_connection(
+            path, limit=2 ** 24)
+        sent = {}
+        window_ = asyncio.Semaphore(window)
+
+        async def send():
+            for i in range(count):
+                await window_.acquire()
+                sent[i] = monotonic()
+                writer.write(json.dumps({'id': i, 'text': text}).encode()
+                             + b'\n')
+                await writer.drain()
+
+        sender = asyncio.ensure_future(send())
+        for _ in range(count):
+            response = json.loads((await reader.readline()).decode())
+            latencies.append(monotonic() - sent.pop(response['id']))
+            window_.release()
+        await sender
+        writer.close()
+
+    per_client = requests // connections
+    await asyncio.gather(*[client(per_client) for _ in range(connections)])
+    return latencies
+
+
+def bench_server():
+    '''latency and throughput of the conversion server'''
+    text = make_document(5)
+    command = ('import sys, pyorg; '
+               'sys.stdout.write(pyorg.org_to_html(sys.stdin.read()))')
+    start = monotonic()
+    for _ in range(10):
+        subprocess.run([sys.executable, '-c', command], input=text.encode(),
+                       stdout=subprocess.DEVNULL, check=True)
+    report('new process per request', (monotonic() - start) / 10)
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'sock')
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'pyorg', 'serve', '--socket', path])
+        try:
+            while not os.path.exists(path):
+                if server.poll() is not None:
+                    raise RuntimeError('server exited')
+                sleep(0.05)
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(load(path, text, 4, 400, 16))
+            for connections, window in ((1, 1), (8, 1), (8, 16), (32, 16)):
+                start = monotonic()
+                latencies = loop.run_until_complete(
+                    load(path, text, connections, 4000, window))
+                seconds = monotonic() - start
+                print('{:>2} connections x {:>2} pipelined: '
+                      'p50 {:6.2f} ms  p99 {:6.2f} ms  {:8.0f} req/s'.format(
+                          connections, window,
+                          percentile(latencies, 50) * 1000,
+                          percentile(latencies, 99) * 1000,
+                          len(latencies) / seconds))
+            loop.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_lazy():
+    '''building a table of contents eagerly and lazily'''
+    for sections in (1000, 4000):
+        for lines in (10, 100):
+            text = make_document(sections, line='\n'.join(
+                ['paragraph text with some words in it'] * lines))
+            for cls in (Org, LazyOrg):
+                toc = lambda: [(h.depth, h.title) for h in cls(text).headings()]
+                report('toc of {} headings, {} lines, {}'.format(
+                    sections * 2, text.count('\n'), cls.__name__),
+                    best_of(toc, repeat_=3), len(text))
+
+
+def bench_memory():
+    '''peak memory per source byte and the top allocation sites in org.py'''
+    text = make_document(2000)
+    o = Org(text)
+    for label, func in (
+            ('parse', lambda: Org(text)),
+            ('render', o.html),
+            ('lazy headings', lambda: list(LazyOrg(text).headings())),
+            ('iter_tables', lambda: list(iter_tables(text)))):
+        _, peak = traced(func)
+        print('{:<48} {:>10.2f} B/B'.format(
+            'peak memory, {}'.format(label), peak / len(text)))
+    del o
+    tracemalloc.start(1)
+    try:
+        # the tree is kept alive until its allocations are recorded
+        tree = Org(text)
+        snapshot = tracemalloc.take_snapshot()
+        del tree
+    finally:
+        tracemalloc.stop()
+    snapshot = snapshot.filter_traces(
+        [tracemalloc.Filter(True, pyorg.org.__file__)])
+    lines = text.count('\n')
+    print('top allocation sites of the parsed tree:')
+    for stat in snapshot.statistics('lineno')[:10]:
+        frame = stat.traceback[0]
+        print('  org.py:{:<5} {:>8.2f} MB {:>6.2f} blocks/line  {}'.format(
+            frame.lineno, stat.size / 1e6, stat.count / lines,
+            linecache.getline(frame.filename, frame.lineno).strip()))
+
+
+def bench_many():
+    '''snippets/s of org_to_html in a loop and of org_to_html_many'''
+    snippets = {
+        'one line': ['nice post, thanks!', 'see *this* and [[http://a.b][that]]'],
+        'two lines': ['first line of a comment\nand the second =one='],
+        'list': ['- one\n- two'],
+    }
+    for label, texts in sorted(snippets.items()):
+        texts = texts * (100000 // len(texts))
+        for name, convert in (
+                ('org_to_html loop', lambda: [org_to_html(t) for t in texts]),
+                ('org_to_html_many', lambda: list(org_to_html_many(texts))),
+                ('org_to_html_many, intern',
+                 lambda: list(org_to_html_many(texts, intern=True)))):
+            seconds = best_of(convert, repeat_=3)
+            print('{:<48} {:>10.0f} snippets/s'.format(
+                '{}, {}'.format(label, name), len(texts) / seconds))
+
+
+def bench_threads():
+    '''documents/s of one shared Parser in threads; it only scales on a
+    free-threaded build'''
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('GIL enabled: {}, CPUs: {}'.format(gil, os.cpu_count()))
+    texts = [make_document(20)] * 400
+    for intern in (False, True):
+        parser = Parser(intern=intern)
+        base = None
+        for threads in (1, 2, 4, 8):
+            with ThreadPoolExecutor(threads) as pool:
+                seconds = best_of(
+                    lambda: list(pool.map(parser.html, texts)), repeat_=3)
+            base = base or seconds
+            print('{:<36} {:>8.0f} docs/s {:>6.2f}x'.format(
+                '{} threads{}'.format(threads, ', intern' if intern else ''),
+                len(texts) / seconds, base / seconds))
+
+
+def bench_links():
+    '''extracting the links of a document with and without the full parse'''
+
+    def walk(node, links):
+        if isinstance(node, (pyorg.org.Link, pyorg.org.Image)):
+            links.append(node)
+        elif isinstance(node, TerminalNode):
+            for value in node.values:
+                if not isinstance(value, str):
+                    walk(value, links)
+        else:
+            for child in node.children:
+                walk(child, links)
+        return links
+
+    for label, text in (
+            ('dense', make_document(5000)),
+            ('prose', make_document(1000, line='\n'.join(
+                ['paragraph text with some *words* in it'] * 20)))):
+        full = best_of(lambda: walk(Org(text), []), repeat_=3)
+        scan = best_of(lambda: list(extract_links(text)), repeat_=3)
+        report('{} links by full parse'.format(label), full, len(text))
+        report('{} links by extract_links'.format(label), scan, len(text))
+        print('{:<48} {:>10.1f} x'.format('speed up', full / scan))
+
+
+def bench_diff():
+    '''patching the HTML of a document after an edit, against rendering it'''
+    for sections in (100, 1000, 5000):
+        text = make_document(sections)
+        edited = text.replace('Heading 7\n', 'Heading 7.\n')
+        # the old tree is frozen and was keyed by the diff which sent it;
+        # the new one is keyed on every call
+        old, new = Org(text).freeze(), Org(edited)
+        diff(old, old)
+        html = new.html()
+        render = best_of(new.html, repeat_=3)
+        patch = best_of(lambda: diff(old, new), repeat_=3)
+        size = sum(len(fragment) for p in diff(old, new) for fragment in p.html)
+        print('{:>5} sections: render {:8.2f} ms {:>8} B, '
+              'diff {:8.2f} ms {:>6} B'.format(
+                  sections, render * 1000, len(html), patch * 1000, size))
+        assert patch < render, 'diff slower than a render'
+
+
+BENCHMARKS = {
+    'adversarial': bench_adversarial,
+    'diff': bench_diff,
+    'escape': bench_escape,
+    'inline_registry': bench_inline_registry,
+    'intern': bench_intern,
+    'lazy': bench_lazy,
+    'links': bench_links,
+    'many': bench_many,
+    'memory': bench_memory,
+    'plain': bench_plain,
+    'server': bench_server,
+    'tables': bench_tables,
+    'threads': bench_threads,
+    'watch': bench_watch,
+}
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
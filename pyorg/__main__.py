@@ -0,0 +1,63 @@
+'''Command line interface
+
+usage: python -m pyorg watch SRC [DEST]
+       python -m pyorg serve [--socket PATH]
+'''
+import argparse
+import sys
+
+from .server import serve
+from .watch import Site, watch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pyorg')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser(
+        'watch', help='convert org files under SRC and rebuild on change')
+    p.add_argument('src')
+    p.add_argument('dest', nargs='?',
+                   help='output directory (default: SRC)')
+    p.add_argument('--interval', type=float, default=0.5,
+                   help='seconds between polls')
+    p.add_argument('--debounce', type=float, default=0.1,
+                   help='seconds without changes before rebuilding')
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--default-heading', type=int, default=1)
+    p.add_argument('--newline', default='')
+
+    p = commands.add_parser(
+        'serve', help='serve conversion requests, one JSON object per line')
+    p.add_argument('--socket',
+                   help='unix socket path (default: stdin and stdout)')
+    p.add_argument('--workers', type=int, default=None,
+                   help='worker processes (default: CPU count)')
+    p.add_argument('--max-pending', type=int, default=64,
+                   help='requests in flight per connection')
+    p.add_argument('--timeout', type=float, default=10.0,
+                   help='seconds before a request fails')
+
+    args = parser.parse_args(argv)
+    if args.command == 'watch':
+        site = Site(args.src, args.dest or args.src,
+                    default_heading=args.default_heading,
+                    newline=args.newline, workers=args.workers)
+        try:
+            watch(site, interval=args.interval, debounce=args.debounce)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            site.close()
+    elif args.command == 'serve':
+        try:
+            serve(args.socket, workers=args.workers,
+                  max_pending=args.max_pending, timeout=args.timeout)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+'''HTML patches between two parsed versions of a document
+
+A document is rendered as a list of fragments, one per unit: the blocks
+before the first heading, or a heading with the blocks of its body up to
+its first subheading. ''.join(fragments) is the HTML of the document.
+diff matches the units of two trees by the source text they span, and
+renders only the units of the new tree which are not in the old one.
+'''
+from collections import namedtuple
+from difflib import SequenceMatcher
+from itertools import chain
+from re import compile
+
+from .org import Heading, LazyOrg, Org
+
+
+# op is 'replace', 'insert' or 'delete' of the old fragments
+# [start:end]; html is the list of new fragments put in their place
+Patch = namedtuple('Patch', 'op start end html')
+
+# the lines which may start a heading, a source block or a quote block,
+# found as LazyOrg finds them
+SCAN = compile(r'\n(?P<line>(?:\*|#\+(?:BEGIN|END)_(?:SRC|QUOTE))[^\n]*)')
+FIRST_LINE = compile(r'(?P<line>(?:\*|#\+(?:BEGIN|END)_(?:SRC|QUOTE))[^\n]*)')
+
+
+class Unit(object):
+    '''Heading with its body, or the blocks before the first heading'''
+    def __init__(self, heading, prefix, blocks=None):
+        self.heading = heading
+        self.prefix = prefix
+        self._blocks = blocks
+        self._key = None
+
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            self._blocks = [child for child in self.heading.children
+                            if not isinstance(child, Heading)]
+        return self._blocks
+
+    def key(self):
+        '''returns a value equal for units rendering equal HTML, built
+        from the nodes'''
+        if self._key is None:
+            heading = self.heading
+            key = tuple([block.key() for block in self.blocks])
+            if heading is not None:
+                key = (heading.__class__, heading.title_html(), key)
+            self._key = (self.prefix, key)
+        return self._key
+
+    def html(self, br=''):
+        if self.heading is None:
+            return self.prefix + br.join(
+                [block.html(br) for block in self.blocks])
+        return self.prefix + self.heading.title_html() + ''.join(
+            [block.html(br) for block in self.blocks])
+
+
+def units(org, newline=''):
+    '''returns the units of org in document order
+
+    consecutive top level blocks form one unit; only the first unit,
+    before the first heading, is one in a well formed document.'''
+    result = []
+    for i, child in enumerate(org.blocks()):
+        prefix = newline if i else ''
+        if not isinstance(child, Heading):
+            if result and result[-1].heading is None:
+                result[-1].blocks.append(child)
+            else:
+                result.append(Unit(None, prefix, [child]))
+            continue
+        todo = [(child, prefix)]
+        while todo:
+            heading, prefix = todo.pop()
+            result.append(Unit(heading, prefix))
+            todo.extend((subheading, '') for subheading
+                        in reversed(heading.subheadings))
+    return result
+
+
+def fragments(org, newline=''):
+    '''returns the HTML fragments of the units of org'''
+    return [unit.html(newline) for unit in units(org, newline)]
+
+
+def source_keys(org, units):
+    '''returns the keys of units built from the source text they span
+
+    a unit renders the same HTML wherever its source text occurs, given
+    the depth and id of its heading. returns None when the headings of
+    the tree are not those of the source, or when a quote block is left
+    open across a heading, so the units can not be told apart by text.'''
+    text = org.text
+    if any(char in text for char in LazyOrg.line_breaks):
+        text = '\n'.join(text.splitlines())
+    regexps = Org.regexps
+    starts = []
+    titles = []
+    src_flg = quote_flg = False
+    first = FIRST_LINE.match(text)
+    for m in chain([first] if first else [], SCAN.finditer(text)):
+        line = m.group('line')
+        if src_flg:
+            src_flg = not regexps['src_end'].match(line)
+            continue
+        heading = regexps['heading'].match(line)
+        if heading:
+            if quote_flg:
+                return None
+            starts.append(m.start('line'))
+            titles.append(heading.group('title'))
+        elif regexps['blockquote_begin'].match(line):
+            quote_flg = True
+        elif regexps['blockquote_end'].match(line):
+            quote_flg = False
+        elif regexps['src_begin'].match(line):
+            src_flg = True
+    headings = [unit.heading for unit in units if unit.heading is not None]
+    if titles != [heading.title for heading in headings]:
+        return None
+    keys = []
+    if len(headings) < len(units):
+        if len(headings) + 1 < len(units) or units[0].heading is not None:
+            return None
+        keys.append(('', text[:starts[0] if starts else len(text)]))
+    ends = starts[1:] + [len(text)]
+    for unit, start, end in zip(units[len(keys):], starts, ends):
+        heading = unit.heading
+        keys.append((unit.prefix, heading.depth, heading.id, text[start:end]))
+    return keys
+
+
+def keyed(org, newline=''):
+    '''returns the units of org and their source keys, or None for keys
+
+    the result is kept on a frozen org, which can not change, so a tree
+    is keyed once however often it is diffed.'''
+    memo = org.__dict__.get('_diff_units')
+    if memo is not None and memo[0] == newline:
+        return memo[1], memo[2]
+    result = units(org, newline)
+    keys = source_keys(org, result)
+    if isinstance(org.children, tuple):
+        org._diff_units = (newline, result, keys)
+    return result, keys
+
+
+def diff(old, new, newline=''):
+    '''returns the Patches turning the fragments of old into those of new
+
+    units are matched by the source text they span, or by the structure
+    of their nodes when that is not possible. the units equal at the
+    start and the end are skipped before the rest is matched, and only
+    the units changed are rendered. the keys of a frozen tree are
+    kept on it.'''
+    a, a_keys = keyed(old, newline)
+    b, b_keys = keyed(new, newline)
+    if a_keys is None or b_keys is None:
+        a_keys = [unit.key() for unit in a]
+        b_keys = [unit.key() for unit in b]
+    start = 0
+    end = min(len(a), len(b))
+    while start < end and a_keys[start] == b_keys[start]:
+        start += 1
+    tail = 0
+    while tail < end - start and a_keys[-1 - tail] == b_keys[-1 - tail]:
+        tail += 1
+    matcher = SequenceMatcher(None, a_keys[start:len(a) - tail],
+                              b_keys[start:len(b) - tail], autojunk=False)
+    patches = []
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == 'equal':
+            continue
+        patches.append(Patch(op, start + i1, start + i2,
+                             [unit.html(newline)
+                              for unit in b[start + j1:start + j2]]))
+    return patches
+
+
+def apply(fragments, patches):
+    '''returns the new fragments, as a client applies patches'''
+    fragments = list(fragments)
+    for patch in reversed(patches):
+        fragments[patch.start:patch.end] = patch.html
+    return fragments
@@ -1,15 +1,23 @@
-from re import compile
+from array import array
+from collections import OrderedDict, namedtuple
+from itertools import chain
+from re import compile, escape as re_escape
+from threading import Lock
+from time import monotonic
 
 
 class Syntax(object):
-    LINK = r'\[\[(?P<url>https?://.+?)\](?:\[(?P<subject>.+?)\])?\]'
-    IMAGE = r'\[\[(?P<image>.+?)\](?:\[(?P<alt>.+?)\])?\]'
-    BOLD = r'\*(?P<text>.+?)\*'
-    ITALIC = r'/(?P<text>.+?)/'
-    UNDERLINED = r'_(?P<text>.+?)_'
-    LINETHROUGH = r'\+(?P<text>.+?)\+'
-    CODE = r'=(?P<text>.+?)='
-    MONOSPACE = r'~(?P<text>.+?)~'
+    # every pattern matches in time linear in the length of the line:
+    # repeated or lazy parts are delimited by characters they can not
+    # contain, so a failed attempt never rescans what it already read.
+    LINK = r'\[\[(?P<url>https?://[^\[\]]+)\](?:\[(?P<subject>[^\[\]]+)\])?\]'
+    IMAGE = r'\[\[(?P<image>[^\[\]]+)\](?:\[(?P<alt>[^\[\]]+)\])?\]'
+    BOLD = r'\*(?P<text>[^*]+)\*'
+    ITALIC = r'/(?P<text>[^/]+)/'
+    UNDERLINED = r'_(?P<text>[^_]+)_'
+    LINETHROUGH = r'\+(?P<text>[^+]+)\+'
+    CODE = r'=(?P<text>[^=]+)='
+    MONOSPACE = r'~(?P<text>[^~]+)~'
     WHITELINE = r'\s*$'
     HEADING = r'(?P<level>\*+)\s+(?P<title>.+)$'
     QUOTE_BEGIN = r'#\+BEGIN_QUOTE(?P<c>:)?(?(c)\s+(?P<cite>.+)|)$'
@@ -18,8 +26,24 @@ class Syntax(object):
     SRC_END = r'#\+END_SRC'
     ORDERED_LIST = r'(?P<depth>\s*)\d+(\.|\))\s+(?P<item>.+)$'
     UNORDERED_LIST = r'(?P<depth>\s*)(-|\+)\s+(?P<item>.+)$'
-    DEF_LIST = r'(?P<depth>\s*)(-|\+)\s+(?P<item>.+?)\s*::\s*(?P<desc>.+)$'
-    TABLE_ROW = r'\s*\|(?P<cells>(.+\|)+)s*$'
+    # item keeps the whitespace before '::', it is stripped by the parser
+    DEF_LIST = r'(?P<depth>\s*)(-|\+)\s+(?P<item>\S.*?)::\s*(?P<desc>.+)$'
+    TABLE_ROW = r'\s*\|(?P<cells>(?:[^|]*\|)+)\s*$'
+
+
+def escape(value):
+    '''returns value with the HTML special characters &<>"' replaced
+
+    strings without any special character are returned as is, so
+    escaping plain text costs a few memchr scans and no copy.'''
+    if ('&' in value or '<' in value or '>' in value or
+            '"' in value or "'" in value):
+        return (value.replace('&', '&amp;')
+                .replace('<', '&lt;')
+                .replace('>', '&gt;')
+                .replace('"', '&quot;')
+                .replace("'", '&#x27;'))
+    return value
 
 
 class BaseError(Exception):
@@ -30,6 +54,44 @@ class NestingNotValidError(BaseError):
     pass
 
 
+class LimitExceededError(BaseError):
+    '''raised when parsing exceeds one of the Limits'''
+    def __init__(self, limit, maximum):
+        super().__init__(limit, maximum)
+        self.limit = limit
+        self.maximum = maximum
+
+    def __str__(self):
+        return '{} of {} exceeded'.format(self.limit, self.maximum)
+
+
+class Limits(object):
+    '''Resource limits for parsing untrusted input
+
+    max_line_length: characters in one line
+    max_depth: nesting depth of block nodes
+    max_nodes: block nodes and inline values in the document
+    max_work: characters parsed, table cells are parsed once more
+    timeout: seconds spent parsing
+    any limit can be disabled with None.'''
+    def __init__(self, max_line_length=10000, max_depth=100,
+                 max_nodes=1000000, max_work=10000000, timeout=None):
+        self.max_line_length = max_line_length
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.max_work = max_work
+        self.timeout = timeout
+
+
+class _Usage(object):
+    '''Resources used by a parse, counted against its Limits'''
+    def __init__(self, limits):
+        self.nodes = self.work = 0
+        self.deadline = None
+        if limits.timeout is not None:
+            self.deadline = monotonic() + limits.timeout
+
+
 class Node(object):
     '''Base class of all node'''
     def __init__(self, parent=None):
@@ -47,6 +109,18 @@ class Node(object):
         self.children.append(child)
         child.parent = self
 
+    def key(self):
+        '''returns a hashable value, equal for nodes rendering equal HTML'''
+        return (self.__class__, self._get_open(),
+                tuple([child.key() for child in self.children]))
+
+    def freeze(self):
+        '''makes children and those of every descendant tuples'''
+        for child in self.children:
+            child.freeze()
+        self.children = tuple(self.children)
+        return self
+
     def html(self, br='', lstrip=False):
         '''Get HTML'''
         inner = br.join([child.html(br, lstrip) for child in self.children])
@@ -61,74 +135,208 @@ class Node(object):
         raise NotImplementedError
 
 
+class InlineSyntax(object):
+    '''Inline construct
+
+    delimiters are the characters the construct can open with; the
+    regexp is only tried on values containing one of them.
+    factory is called with the groups of the match.'''
+    def __init__(self, name, pattern, delimiters, factory):
+        self.name = name
+        self.regexp = compile(pattern)
+        self.delimiters = delimiters
+        self.factory = factory
+
+
+class InlineRegistry(object):
+    '''Registry of inline constructs, in priority order
+
+    lookups may run in several threads while constructs are registered:
+    the list of constructs is replaced instead of changed, and the
+    lookup tables built from it are published together at once.'''
+    def __init__(self, syntaxes=()):
+        self.syntaxes = list(syntaxes)
+        self._compiled = None
+        self._lock = Lock()
+
+    def register(self, name, pattern, delimiters, factory, before=None):
+        '''registers an inline construct
+
+        the construct is tried after all already registered ones, or
+        just before the construct named before.'''
+        syntax = InlineSyntax(name, pattern, delimiters, factory)
+        with self._lock:
+            syntaxes = list(self.syntaxes)
+            if before is None:
+                syntaxes.append(syntax)
+            else:
+                names = [s.name for s in syntaxes]
+                syntaxes.insert(names.index(before), syntax)
+            self.syntaxes = syntaxes
+            self._compiled = None
+        return syntax
+
+    def unregister(self, name):
+        with self._lock:
+            self.syntaxes = [s for s in self.syntaxes if s.name != name]
+            self._compiled = None
+
+    def copy(self):
+        return InlineRegistry(self.syntaxes)
+
+    def regexps(self):
+        return {syntax.name: syntax.regexp for syntax in self.syntaxes}
+
+    def compile(self):
+        '''builds the delimiter character -> constructs lookup table'''
+        return self._compile()[0]
+
+    def _compile(self):
+        with self._lock:
+            table = {}
+            for priority, syntax in enumerate(self.syntaxes):
+                for char in syntax.delimiters:
+                    table.setdefault(char, []).append((priority, syntax))
+            # an empty class never matches; (?!) keeps the pattern valid
+            chars = ''.join(re_escape(char) for char in table)
+            search = compile('[' + chars + ']' if chars else '(?!)').search
+            self._compiled = compiled = (table, frozenset(table), search)
+        return compiled
+
+    def has_markup(self, value):
+        '''returns whether any registered delimiter occurs in value'''
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self._compile()
+        return compiled[2](value) is not None
+
+    def candidates(self, value):
+        '''returns constructs which can occur in value, in priority order'''
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self._compile()
+        table, delimiters, _ = compiled
+        present = delimiters.intersection(value)
+        if not present:
+            return []
+        if len(present) == 1:
+            found = table[next(iter(present))]
+        else:
+            found = sorted(set(entry for char in present
+                               for entry in table[char]),
+                           key=lambda entry: entry[0])
+        return [syntax for _, syntax in found]
+
+
+class InlineCache(object):
+    '''Bounded memo table of parsed inline values
+
+    identical strings share one parsed, immutable (tuple) values.
+    the least recently used entry is dropped when maxsize is reached.
+    a cache may be shared by threads; values are parsed outside of its
+    lock, so two threads missing the same string both parse it.'''
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def parse(self, value, parse_value):
+        '''returns the cached values of value, parsing it on a miss'''
+        with self._lock:
+            values = self._values.get(value)
+            if values is not None:
+                self.hits += 1
+                self._values.move_to_end(value)
+                return values
+            self.misses += 1
+        # the values are shared by every document parsing value, so the
+        # inline nodes in them are frozen too
+        values = tuple([v if isinstance(v, str) else v.freeze()
+                        for v in parse_value(value)])
+        with self._lock:
+            self._values[value] = values
+            if len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+        return values
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
 class TerminalNode(object):
     '''Base class of all terminal node'''
-    regexps = {
-        'link': compile(Syntax.LINK),
-        'image': compile(Syntax.IMAGE),
-        'bold': compile(Syntax.BOLD),
-        'italic': compile(Syntax.ITALIC),
-        'underlined': compile(Syntax.UNDERLINED),
-        'linethrough': compile(Syntax.LINETHROUGH),
-        'code': compile(Syntax.CODE),
-        'monospace': compile(Syntax.MONOSPACE)
-    }
+    inline_syntax = InlineRegistry()
 
-    def __init__(self, value, parent=None, noparse=False):
+    def __init__(self, value, parent=None, noparse=False, cache=None):
         self.type_ = self.__class__.__name__
         self.noparse = noparse
-        self.values = self._parse_value(value)
+        if cache is None or noparse or value is None:
+            self.values = self._parse_value(value)
+        else:
+            self.values = cache.parse(value, self._parse_value)
         self.parent = parent
 
     def _parse_value(self, value):
         if value is None:
             return ''
-
-        if self.noparse:
-            before = after = None
-            parsed = value
-        elif self.regexps['code'].search(value):
-            before, text, after = self.regexps['code'].split(value, 1)
-            parsed = InlineCodeText(text)
-        elif self.regexps['link'].search(value):
-            before, url, subject, after = self.regexps['link'].split(value, 1)
-            parsed = Link(url, subject)
-        elif self.regexps['image'].search(value):
-            before, src, alt, after = self.regexps['image'].split(value, 1)
-            parsed = Image(src, alt)
-        elif self.regexps['bold'].search(value):
-            before, text, after = self.regexps['bold'].split(value, 1)
-            parsed = BoldText(text)
-        elif self.regexps['italic'].search(value):
-            before, text, after = self.regexps['italic'].split(value, 1)
-            parsed = ItalicText(text)
-        elif self.regexps['underlined'].search(value):
-            before, text, after = self.regexps['underlined'].split(value, 1)
-            parsed = UnderlinedText(text)
-        elif self.regexps['linethrough'].search(value):
-            before, text, after = self.regexps['linethrough'].split(value, 1)
-            parsed = LinethroughText(text)
-        elif self.regexps['monospace'].search(value):
-            before, text, after = self.regexps['monospace'].split(value, 1)
-            parsed = MonospaceText(text)
-        else:
-            before = after = None
-            parsed = value
-        before = self._parse_value(before) or []
-        after = self._parse_value(after) or []
-        return before + [parsed] + after
+        if self.noparse or not self.inline_syntax.has_markup(value):
+            return [value]
+
+        values = []
+        syntaxes = self.inline_syntax.candidates(value)
+        matches = [syntax.regexp.search(value) for syntax in syntaxes]
+        pos = 0
+        while True:
+            # the text from pos is parsed in place instead of slicing it
+            # off; a remembered match is reused while it starts at or
+            # after pos, so the whole value is scanned once per construct
+            for i, syntax in enumerate(syntaxes):
+                m = matches[i]
+                if m is not None and m.start() < pos:
+                    m = matches[i] = syntax.regexp.search(value, pos)
+                if m is not None:
+                    break
+            else:
+                break
+            # no construct of higher priority occurs in the text before
+            # the match, so this recursion is bounded by the registry size
+            values.extend(self._parse_value(value[pos:m.start()]))
+            values.append(syntax.factory(*m.groups()))
+            pos = m.end()
+        values.append(value[pos:])
+        return values
 
     def __str__(self):
         return self.type_
 
+    def key(self):
+        '''returns a hashable value, equal for nodes rendering equal HTML'''
+        return (self.__class__, self._get_open(), tuple([
+            value if isinstance(value, str) else value.key()
+            for value in self.values]))
+
+    def freeze(self):
+        '''makes values and those of the inline nodes in it tuples'''
+        for value in self.values:
+            if not isinstance(value, str):
+                value.freeze()
+        if isinstance(self.values, list):
+            self.values = tuple(self.values)
+        return self
+
     def html(self, br='', lstrip=False):
         content = ''
         for value in self.values:
             if isinstance(value, str):
                 if lstrip:
-                    content += value.strip()
+                    content += escape(value.strip())
                 else:
-                    content += value.rstrip()
+                    content += escape(value.rstrip())
             else:
                 content += value.html(br)
         return self._get_open() + content + self._get_close()
@@ -201,8 +409,6 @@ class LinethroughText(Text):
 
 class InlineCodeText(Text):
     '''Inline Code Text Class'''
-    less_than = compile(r'<')
-    greater_than = compile(r'>')
     def _parse_value(self, value):
         return [value]
 
@@ -210,11 +416,9 @@ class InlineCodeText(Text):
         content = ''
         for value in self.values:
             if isinstance(value, str):
-                content += value.strip()
+                content += escape(value.strip())
             else:
                 content += value.html(br)
-        content = self.less_than.sub('&lt;', content)
-        content = self.greater_than.sub('&gt;', content)
         return self._get_open() + content + self._get_close()
 
     def _get_open(self):
@@ -241,7 +445,7 @@ class Blockquote(Node):
 
     def _get_open(self):
         if self.cite:
-            return '<blockquote cite="{}">'.format(self.cite)
+            return '<blockquote cite="{}">'.format(escape(self.cite))
         else:
             return '<blockquote>'
 
@@ -257,7 +461,7 @@ class CodeBlock(Node):
 
     def _get_open(self):
         if self.src_type:
-            return '<pre><code class="{}">'.format(self.src_type)
+            return '<pre><code class="{}">'.format(escape(self.src_type))
         else:
             return '<pre><code>'
 
@@ -265,26 +469,80 @@ class CodeBlock(Node):
         return '</code></pre>'
 
 
+TocEntry = namedtuple('TocEntry', 'depth title slug')
+
+_non_word = compile(r'[\W_]+')
+
+
+def slugify(title):
+    '''returns an id for title: lowercase words joined with -'''
+    return _non_word.sub('-', title.lower()).strip('-') or 'section'
+
+
 class Heading(Node):
     '''Heading Class'''
     def __init__(self, depth, title, default_depth=1):
         self.depth = depth + (default_depth -1)
         self.title = title
+        self.id = None
         super().__init__()
         self.type_ = 'Heading{}'.format(self.depth)
 
+    @property
+    def subheadings(self):
+        return [child for child in self.children
+                if isinstance(child, Heading)]
+
     def html(self, br=''):
-        heading = self._get_open() + self.title + self._get_close()
         content = ''.join([child.html(br) for child in self.children])
-        return heading + content
+        return self.title_html() + content
+
+    def key(self):
+        return (self.__class__, self.title_html(),
+                tuple([child.key() for child in self.children]))
+
+    def title_html(self):
+        return self._get_open() + escape(self.title) + self._get_close()
 
     def _get_open(self):
+        if self.id is not None:
+            return '<h{} id="{}">'.format(self.depth, escape(self.id))
         return '<h{}>'.format(self.depth)
 
     def _get_close(self):
         return '</h{}>'.format(self.depth)
 
 
+class LazyHeading(Heading):
+    '''Heading whose body is parsed when children is first accessed'''
+    def __init__(self, depth, title, default_depth, org, body):
+        super().__init__(depth, title, default_depth)
+        self.subheadings = []
+        self._org = org
+        self._body = body
+        self._children = None
+
+    @property
+    def children(self):
+        if self._children is None:
+            children = self._org._parse_body(self._body, self)
+            self._children = children + self.subheadings
+            self._body = None
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+
+    @property
+    def subheadings(self):
+        return self._subheadings
+
+    @subheadings.setter
+    def subheadings(self, subheadings):
+        self._subheadings = subheadings
+
+
 class List(Node):
     '''List Class'''
     def __init__(self, depth, ordered, definition, start=1):
@@ -346,10 +604,11 @@ class DefinitionList(List):
 
 class DefinitionListItem(Node):
     '''Definition List Item Class'''
-    def __init__(self, title, description):
+    def __init__(self, title, description, cache=None):
         super().__init__()
-        self.children.append(DefinitionListItemTitle(title))
-        self.children.append(DefinitionListItemDescription(description))
+        self.children.append(DefinitionListItemTitle(title, cache=cache))
+        self.children.append(
+            DefinitionListItemDescription(description, cache=cache))
 
     def _get_open(self):
         return ''
@@ -374,8 +633,107 @@ class DefinitionListItemDescription(TerminalNode):
         return '</dd>'
 
 
+class ColumnTable(object):
+    '''Table data stored by column
+
+    integer and float columns are array.array('q') and array('d') (or
+    numpy arrays with numpy=True), other columns are lists of the cells'
+    source text, markup included. integers too large for 'q' are kept
+    as text.
+    rule rows, starting with |- as in Org, are dropped; when one follows the first row,
+    that row gives the column names. rules before the first row are
+    borders and do not count.'''
+    def __init__(self, columns, names=None):
+        self.columns = columns
+        self.names = names
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if self.names is None or key not in self.names:
+                raise KeyError(key)
+            key = self.names.index(key)
+        return self.columns[key]
+
+    @classmethod
+    def from_rows(cls, rows, numpy=False):
+        '''builds a table from rows of stripped cell strings, None for
+        a rule row'''
+        builder = _ColumnBuilder()
+        for cells in rows:
+            builder.add(cells)
+        return builder.build(numpy)
+
+
+class _ColumnBuilder(object):
+    '''appends rows of cells straight to per column lists'''
+    def __init__(self):
+        self.columns = []
+        self.names = None
+        self.rows = 0
+        self.seen_rule = False
+
+    def add(self, cells):
+        '''adds a row of stripped cells, or a rule row given as None'''
+        if cells is None:
+            if self.rows == 1 and not self.seen_rule:
+                self.names = [column.pop() for column in self.columns]
+                self.rows = 0
+                self.seen_rule = True
+            elif self.rows:
+                self.seen_rule = True
+            return
+        columns = self.columns
+        if len(cells) > len(columns):
+            columns.extend([''] * self.rows
+                           for _ in range(len(cells) - len(columns)))
+        for column, cell in zip(columns, cells):
+            column.append(cell)
+        for column in columns[len(cells):]:
+            column.append('')
+        self.rows += 1
+
+    def build(self, numpy=False):
+        return ColumnTable([_typed_column(column, numpy)
+                            for column in self.columns], self.names)
+
+
+# the numbers a typed column holds; int() and float() also take nan,
+# inf, 1_000 and non-ASCII digits, which are text in a table
+_INTEGER = compile(r'[-+]?[0-9]+\Z').match
+_FLOAT = compile(
+    r'[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?\Z').match
+
+
+def _typed_column(values, numpy=False):
+    if all(_INTEGER(value) for value in values):
+        try:
+            column = array('q', map(int, values))
+        except OverflowError:
+            return values
+    elif all(_FLOAT(value) for value in values):
+        column = array('d', map(float, values))
+    else:
+        return values
+    if numpy:
+        import numpy
+        return numpy.asarray(column)
+    return column
+
+
 class Table(Node):
     '''Table Class'''
+    def to_columns(self, numpy=False):
+        '''returns the source text of the cells as a ColumnTable, like
+        iter_tables'''
+        return ColumnTable.from_rows(
+            (None if row.rule else
+             [cell.text.strip() for cell in row.children]
+             for row in self.children if isinstance(row, TableRow)),
+            numpy)
+
     def _get_open(self):
         return '<table>'
 
@@ -384,7 +742,11 @@ class Table(Node):
 
 
 class TableRow(Node):
-    '''Table Row Class'''
+    '''Table Row Class
+
+    rule is True for a row starting with |-, a horizontal rule in Org'''
+    rule = False
+
     def _get_open(self):
         return '<tr>'
 
@@ -393,7 +755,13 @@ class TableRow(Node):
 
 
 class TableCell(Node):
-    '''Table Cell Class'''
+    '''Table Cell Class
+
+    text is the source of the cell, its markup unparsed'''
+    def __init__(self, text=''):
+        self.text = text
+        super().__init__()
+
     def html(self, br='', lstrip=False):
         '''Get HTML'''
         inner = br.join([child.html(br, True) for child in self.children])
@@ -410,12 +778,13 @@ class Link(TerminalNode):
     '''Link Class'''
     def __init__(self, href, title):
         self.href = href
+        self.subject = title
         if title is None:
             title = href
         super().__init__(title)
 
     def _get_open(self):
-        return '<a href="{}">'.format(self.href)
+        return '<a href="{}">'.format(escape(self.href))
 
     def _get_close(self):
         return '</a>'
@@ -425,13 +794,18 @@ class Image(TerminalNode):
     '''Image Class'''
     def __init__(self, src, alt=""):
         self.src = src
+        self.alt = alt
         super().__init__(alt)
 
+    def key(self):
+        return (self.__class__, self.src, self.alt)
+
     def html(self, br=''):
         if self.values:
-            return '<img src="{}" alt="{}">'.format(self.src, self.values[0]) + br
+            return '<img src="{}" alt="{}">'.format(
+                escape(self.src), escape(str(self.values[0]))) + br
         else:
-            return '<img src="{}">'.format(self.src) + br
+            return '<img src="{}">'.format(escape(self.src)) + br
 
 
 class Org(object):
@@ -448,16 +822,43 @@ class Org(object):
         'definitionlist': compile(Syntax.DEF_LIST),
         'tablerow': compile(Syntax.TABLE_ROW),
     }
+    # depth of the parent of the parsed blocks, for the max_depth limit
+    _base_depth = 0
+    # matches every line which may start a block construct or end a
+    # paragraph, and some more; lines it does not match are paragraph text
+    block_regexp = compile(r'\s*(?:[-+]\s|\d+[.)]\s|\|)|\*+\s|#\+')
+
+    def __init__(self, text, default_heading=1, intern=False, limits=None,
+                 anchors=False):
+        '''intern: True or an InlineCache to share the parsed values of
+        identical inline strings (see InlineCache)
+        limits: Limits to parse untrusted input with, LimitExceededError
+        is raised when one is exceeded
+        anchors: give every heading an id attribute, the slug of its toc
+        entry'''
+        self.parent = self
+        self.default_heading = default_heading
+        if intern is True:
+            intern = InlineCache()
+        elif intern is False:
+            intern = None
+        self.cache = intern
+        self.limits = limits
+        self.anchors = anchors
+        self._reset(text)
+        self._parse(self.text)
 
-    def __init__(self, text, default_heading=1):
+    def _reset(self, text):
+        '''clears the state of the previous parse'''
         self.text = text
         self.children = []
-        self.parent = self
         self.current = self
         self.bquote_flg = False
         self.src_flg = False
-        self.default_heading = default_heading
-        self._parse(self.text)
+        self.toc = []
+        self._slugs = {}
+        if self.limits is not None:
+            self._usage = _Usage(self.limits)
 
     def __str__(self):
         return 'Org(' + ' '.join([str(child) for child in self.children]) + ')'
@@ -465,8 +866,10 @@ class Org(object):
     def _parse(self, text):
         text = text.splitlines()
         for line in text:
+            if self.limits is not None:
+                self._check_line(line)
             if self.src_flg and not self.regexps['src_end'].match(line):
-                self.current.append(Text(line, noparse=True))
+                self._append(Text(line, noparse=True))
                 continue
             if self.regexps['heading'].match(line):
                 m = self.regexps['heading'].match(line)
@@ -481,8 +884,7 @@ class Org(object):
                 self.bquote_flg = True
                 m = self.regexps['blockquote_begin'].match(line)
                 node = Blockquote(cite=m.group('cite'))
-                self.current.append(node)
-                self.current = node
+                self._append(node, enter=True)
             elif self.regexps['blockquote_end'].match(line):
                 if not self.bquote_flg:
                     raise NestingNotValidError
@@ -496,8 +898,7 @@ class Org(object):
                 self.src_flg = True
                 m = self.regexps['src_begin'].match(line)
                 node = CodeBlock(src_type=m.group('src_type'))
-                self.current.append(node)
-                self.current = node
+                self._append(node, enter=True)
             elif self.regexps['src_end'].match(line):
                 if not self.src_flg:
                     raise NestingNotValidError
@@ -522,23 +923,69 @@ class Org(object):
                     self.current = self.current.parent
                 m = self.regexps['unorderedlist'].match(line)
                 self._add_ulist_node(m)
-            elif self.regexps['tablerow'].match(line):
-                m = self.regexps['tablerow'].match(line)
+            elif _table_row(line, self.regexps):
+                m = _table_row(line, self.regexps)
                 self._add_tablerow(m)
             elif not line:
                 if isinstance(self.current, Paragraph):
                     self.current = self.current.parent
             elif (not isinstance(self.current, Heading) and
                   isinstance(self.current, Node)):
-                self.current.append(Text(line))
+                self._append(Text(line, cache=self.cache))
             else:
                 node = Paragraph()
-                self.current.append(node)
-                self.current = node
-                self.current.append(Text(line))
+                self._append(node, enter=True)
+                self._append(Text(line, cache=self.cache))
         if self.bquote_flg or self.src_flg:
             raise NestingNotValidError
 
+    def _parse_paragraph(self, lines):
+        '''parses lines which are known to form one paragraph'''
+        for line in lines:
+            if self.limits is not None:
+                self._check_line(line)
+            if self.current is self:
+                self._append(Paragraph(), enter=True)
+            self._append(Text(line, cache=self.cache))
+
+    def _check_line(self, line):
+        limits = self.limits
+        if (limits.max_line_length is not None and
+                len(line) > limits.max_line_length):
+            raise LimitExceededError('max_line_length',
+                                     limits.max_line_length)
+        usage = self._usage
+        usage.work += len(line) + 1
+        if limits.max_work is not None and usage.work > limits.max_work:
+            raise LimitExceededError('max_work', limits.max_work)
+        if usage.deadline is not None and monotonic() > usage.deadline:
+            raise LimitExceededError('timeout', limits.timeout)
+
+    def _append(self, node, enter=False):
+        self.current.append(node)
+        if enter:
+            self.current = node
+        if self.limits is None:
+            return
+        self._count_node(node)
+        limits = self.limits
+        if enter and limits.max_depth is not None:
+            depth = self._base_depth
+            while node is not self:
+                depth += 1
+                if depth > limits.max_depth:
+                    raise LimitExceededError('max_depth', limits.max_depth)
+                node = node.parent
+
+    def _count_node(self, node):
+        usage = self._usage
+        usage.nodes += 1
+        if isinstance(node, TerminalNode):
+            usage.nodes += len(node.values)
+        max_nodes = self.limits.max_nodes
+        if max_nodes is not None and usage.nodes > max_nodes:
+            raise LimitExceededError('max_nodes', max_nodes)
+
     def _is_deeper(self, cls, depth, eq=False):
         if isinstance(self.current, cls) and not eq:
             return depth > self.current.depth
@@ -558,19 +1005,32 @@ class Org(object):
     def _add_heading_node(self, heading):
         while self._is_shallower(Heading, heading.depth, eq=True):
             self.current = self.current.parent
-        self.current.append(heading)
-        self.current = heading
+        self._append(heading, enter=True)
+        self._add_toc_entry(heading)
+
+    def _add_toc_entry(self, heading):
+        slug = slugify(heading.title)
+        if slug in self._slugs:
+            # title-2, title-3, ... skipping slugs taken by other titles
+            n = self._slugs[slug]
+            while '{}-{}'.format(slug, n) in self._slugs:
+                n += 1
+            self._slugs[slug] = n + 1
+            slug = '{}-{}'.format(slug, n)
+        self._slugs[slug] = 2
+        self.toc.append(TocEntry(heading.depth, heading.title, slug))
+        if self.anchors:
+            heading.id = slug
 
     def _add_list_node(self, m, listclass=List):
         is_listclass = isinstance(self.current, listclass)
         depth = len(m.group('depth'))
         if self._is_deeper(listclass, depth) or not is_listclass:
             listnode = listclass(depth=len(m.group('depth')))
-            self.current.append(listnode)
-            self.current = listnode
+            self._append(listnode, enter=True)
         while self._is_shallower(listclass, depth):
             self.current = self.current.parent
-        self.current.append(ListItem(m.group('item')))
+        self._append(ListItem(m.group('item'), cache=self.cache))
 
     def _add_olist_node(self, m):
         self._add_list_node(m, listclass=OrderedList)
@@ -583,27 +1043,25 @@ class Org(object):
         depth = len(m.group('depth'))
         if self._is_deeper(DefinitionList, depth) or not is_definitionlist:
             listnode = DefinitionList(depth=len(m.group('depth')))
-            self.current.append(listnode)
-            self.current = listnode
+            self._append(listnode, enter=True)
         while (isinstance(self.current, DefinitionList) and
                len(m.group('depth')) < self.current.depth):
             self.current = self.current.parent
-        self.current.append(
-            DefinitionListItem(m.group('item'), m.group('desc')))
+        self._append(DefinitionListItem(
+            m.group('item').rstrip(), m.group('desc'), cache=self.cache))
 
     def _add_tablerow(self, m):
         cells = [c for c in m.group('cells').split('|') if c != '']
         if not isinstance(self.current, Table):
             tablenode = Table()
-            self.current.append(tablenode)
-            self.current = tablenode
+            self._append(tablenode, enter=True)
         rownode = TableRow()
-        self.current.append(rownode)
-        self.current = rownode
+        if m.group('cells').startswith('-'):
+            rownode.rule = True
+        self._append(rownode, enter=True)
         for cell in cells:
-            cellnode = TableCell()
-            self.current.append(cellnode)
-            self.current = cellnode
+            cellnode = TableCell(cell)
+            self._append(cellnode, enter=True)
             self._parse(cell)
             self.current = self.current.parent
         self.current = self.current.parent
@@ -617,6 +1075,346 @@ class Org(object):
     def html(self, br=''):
         return br.join([child.html(br) for child in self.children])
 
+    def freeze(self):
+        '''makes the tree and the toc immutable and drops the parse state
+
+        nothing can be parsed into a frozen Org; it is safe to share
+        between threads.'''
+        for child in self.children:
+            child.freeze()
+        self.children = tuple(self.children)
+        self.toc = tuple(self.toc)
+        for name in ('current', 'bquote_flg', 'src_flg', '_slugs',
+                     '_usage'):
+            self.__dict__.pop(name, None)
+        return self
+
+    def tables(self, numpy=False):
+        '''returns the tables of the source text as ColumnTables'''
+        return list(iter_tables(self.text, numpy))
+
+    def toc_html(self):
+        '''returns the table of contents as nested lists linking to the
+        heading anchors'''
+        html = []
+        # depths of the open lists, one list per level of nesting
+        depths = []
+        for entry in self.toc:
+            if not depths or entry.depth > depths[-1]:
+                html.append('<ul>')
+                depths.append(entry.depth)
+            else:
+                html.append('</li>')
+                while len(depths) > 1 and entry.depth <= depths[-2]:
+                    depths.pop()
+                    html.append('</ul></li>')
+                depths[-1] = entry.depth
+            html.append('<li><a href="#{}">{}</a>'.format(
+                escape(entry.slug), escape(entry.title)))
+        if depths:
+            html.append('</li>' + '</ul></li>' * (len(depths) - 1) + '</ul>')
+        return ''.join(html)
+
+    def blocks(self):
+        '''returns an iterator over the top level blocks'''
+        return iter(self.children)
+
+    def headings(self):
+        '''yields every heading in document order'''
+        stack = [child for child in reversed(self.children)
+                 if isinstance(child, Heading)]
+        while stack:
+            heading = stack.pop()
+            yield heading
+            stack.extend(reversed(heading.subheadings))
+
+
+class LazyOrg(Org):
+    '''The org-mode object parsed on demand
+
+    only the heading lines are found up front; the blocks before the
+    first heading and under each heading are parsed when they are
+    first accessed, so walking headings costs time proportional to
+    their number.
+    a quote block left open across a heading raises NestingNotValidError
+    when the body it starts in is parsed.
+    limits apply to the whole document as bodies are parsed; the timeout
+    counts from the creation of the LazyOrg.'''
+    # anchored on a literal newline so the regexp engine can skip ahead
+    # to candidate lines instead of trying every position
+    scan_regexp = compile(r'\n(?P<line>(?:\*|#\+(?:BEGIN|END)_SRC)[^\n]*)')
+    first_line_regexp = compile(r'(?P<line>(?:\*|#\+(?:BEGIN|END)_SRC)[^\n]*)')
+    line_breaks = '\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = list(self.blocks())
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
 
-def org_to_html(text, default_heading=1, newline=''):
-    return Org(text, default_heading).html(newline)
+    def _parse(self, text):
+        if any(char in text for char in self.line_breaks):
+            text = '\n'.join(text.splitlines())
+        self._source = text
+        self._children = None
+        self._preamble = None
+        self._top = []
+        self._headings = []
+        stack = []
+        previous = None
+        src_flg = False
+        first = self.first_line_regexp.match(text)
+        for m in chain([first] if first else [],
+                       self.scan_regexp.finditer(text)):
+            line = m.group('line')
+            if src_flg:
+                src_flg = not self.regexps['src_end'].match(line)
+                continue
+            heading = self.regexps['heading'].match(line)
+            if not heading:
+                src_flg = self.regexps['src_begin'].match(line) is not None
+                continue
+            if self.limits is not None:
+                self._check_line(line)
+            node = LazyHeading(len(heading.group('level')),
+                               heading.group('title'),
+                               self.default_heading, self,
+                               [m.end('line') + 1, None])
+            if previous is None:
+                self._preamble_end = m.start('line')
+            else:
+                previous._body[1] = m.start('line')
+            previous = node
+            while stack and stack[-1].depth >= node.depth:
+                stack.pop()
+            if stack:
+                node.parent = stack[-1]
+                stack[-1].subheadings.append(node)
+            else:
+                node.parent = self
+                self._top.append(node)
+            stack.append(node)
+            self._headings.append(node)
+            self._add_toc_entry(node)
+            if self.limits is not None:
+                self._count_node(node)
+                max_depth = self.limits.max_depth
+                if max_depth is not None and len(stack) > max_depth:
+                    raise LimitExceededError('max_depth', max_depth)
+        if previous is None:
+            self._preamble_end = len(text)
+        else:
+            previous._body[1] = len(text)
+
+    def _parse_body(self, body, parent):
+        start, end = body
+        org = Org('', self.default_heading, self.cache, self.limits)
+        org._reset(self._source[start:end])
+        if self.limits is not None:
+            # the limits apply to the whole document, not to each body
+            org._usage = self._usage
+            node = parent
+            while node is not self:
+                org._base_depth += 1
+                node = node.parent
+        org._parse(org.text)
+        for child in org.children:
+            child.parent = parent
+        return org.children
+
+    def blocks(self):
+        if self._preamble is None:
+            self._preamble = self._parse_body((0, self._preamble_end), self)
+        for block in self._preamble:
+            yield block
+        for heading in self._top:
+            yield heading
+
+    def headings(self):
+        return iter(self._headings)
+
+
+class Parser(object):
+    '''Reentrant org-mode parser
+
+    a Parser only holds its options; the state of each parse lives in
+    the Org it builds, which is frozen before it is returned. one
+    Parser, and its InlineCache, can be shared by any number of threads.
+    intern, limits, anchors: as for Org'''
+    def __init__(self, default_heading=1, intern=False, limits=None,
+                 anchors=False):
+        self.default_heading = default_heading
+        if intern is True:
+            intern = InlineCache()
+        elif intern is False:
+            intern = None
+        self.cache = intern
+        self.limits = limits
+        self.anchors = anchors
+
+    def parse(self, text):
+        '''returns the frozen Org of text'''
+        return Org(text, self.default_heading, self.cache, self.limits,
+                   self.anchors).freeze()
+
+    def html(self, text, newline=''):
+        return self.parse(text).html(newline)
+
+
+inline_syntax = TerminalNode.inline_syntax
+inline_syntax.register('code', Syntax.CODE, '=', InlineCodeText)
+inline_syntax.register('link', Syntax.LINK, '[', Link)
+inline_syntax.register('image', Syntax.IMAGE, '[', Image)
+inline_syntax.register('bold', Syntax.BOLD, '*', BoldText)
+inline_syntax.register('italic', Syntax.ITALIC, '/', ItalicText)
+inline_syntax.register('underlined', Syntax.UNDERLINED, '_', UnderlinedText)
+inline_syntax.register('linethrough', Syntax.LINETHROUGH, '+', LinethroughText)
+inline_syntax.register('monospace', Syntax.MONOSPACE, '~', MonospaceText)
+TerminalNode.regexps = inline_syntax.regexps()
+
+
+def org_to_html(text, default_heading=1, newline='', intern=False,
+                limits=None, anchors=False):
+    return Org(text, default_heading, intern, limits, anchors).html(newline)
+
+
+def org_to_html_many(texts, default_heading=1, newline='', intern=False,
+                     limits=None, anchors=False):
+    '''yields the HTML of each text of texts, like org_to_html
+
+    one Org, with its inline cache, is reset and reused for every text,
+    and a text which is a single paragraph skips the dispatch over the
+    block constructs; without limits it is rendered without building
+    the tree. an error raised by one text ends the iteration.'''
+    org = Org('', default_heading, intern, limits, anchors)
+    cache = org.cache
+    block = Org.block_regexp.match
+    for text in texts:
+        lines = text.splitlines()
+        if not all(line and not block(line) for line in lines):
+            org._reset(text)
+            org._parse(text)
+            yield org.html(newline)
+        elif limits is not None:
+            org._reset(text)
+            org._parse_paragraph(lines)
+            yield org.html(newline)
+        elif lines:
+            yield '<p>' + newline.join(
+                [Text(line, cache=cache).html(newline) for line in lines]
+            ) + '</p>'
+        else:
+            yield ''
+
+
+LinkRecord = namedtuple('LinkRecord', 'url subject line')
+
+
+def _link_values(values):
+    '''yields the Link and Image nodes of values, nested ones included'''
+    for value in values:
+        if isinstance(value, (Link, Image)):
+            yield value
+        elif not isinstance(value, str):
+            for node in _link_values(value.values):
+                yield node
+
+
+def _table_row(line, regexps=Org.regexps):
+    '''returns the match of line as a table row, None for a row of bars
+    only like ||, which is text'''
+    m = regexps['tablerow'].match(line)
+    if m is not None and m.group('cells').strip('|'):
+        return m
+    return None
+
+
+def _link_texts(line, regexps=Org.regexps):
+    '''returns the parts of line which Org parses as inline text'''
+    if regexps['heading'].match(line):
+        return []
+    if line[:2] == '#+' and (regexps['blockquote_begin'].match(line) or
+                             regexps['blockquote_end'].match(line)):
+        return []
+    m = (regexps['orderedlist'].match(line) or
+         regexps['definitionlist'].match(line))
+    if m is not None:
+        if m.re is regexps['definitionlist']:
+            return [m.group('item'), m.group('desc')]
+        return [m.group('item')]
+    m = regexps['unorderedlist'].match(line)
+    if m is not None:
+        return [m.group('item')]
+    m = _table_row(line, regexps)
+    if m is not None:
+        return [text for cell in m.group('cells').split('|') if cell != ''
+                for text in _link_texts(cell, regexps)]
+    return [line]
+
+
+def extract_links(source):
+    '''yields a LinkRecord of every link and image of source
+
+    source is a str or an iterable of lines, e.g. a file; lines are
+    numbered from 1. url is the href of a link or the src of an image,
+    subject its text or alt, None when it has none.
+    only lines containing [[ are parsed, and only into inline values;
+    source blocks and headings are skipped as Org does.'''
+    if isinstance(source, str):
+        source = source.splitlines()
+    src_begin = Org.regexps['src_begin'].match
+    src_end = Org.regexps['src_end'].match
+    src_flg = False
+    for number, line in enumerate(source, 1):
+        line = line.rstrip('\r\n')
+        if line[:2] == '#+':
+            if src_flg:
+                src_flg = not src_end(line)
+                continue
+            if src_begin(line):
+                src_flg = True
+                continue
+        if src_flg or '[[' not in line:
+            continue
+        for text in _link_texts(line):
+            for node in _link_values(Text(text).values):
+                if isinstance(node, Link):
+                    yield LinkRecord(node.href, node.subject, number)
+                else:
+                    yield LinkRecord(node.src, node.alt, number)
+
+
+def iter_tables(source, numpy=False):
+    '''yields the tables of source as ColumnTables
+
+    source is a str or an iterable of lines, e.g. a file.
+    consecutive table rows outside source blocks form one table; the
+    rows are scanned straight into columns without building nodes.'''
+    if isinstance(source, str):
+        source = source.splitlines()
+    src_begin = Org.regexps['src_begin'].match
+    src_end = Org.regexps['src_end'].match
+    src_flg = False
+    builder = None
+    for line in source:
+        if src_flg:
+            src_flg = not src_end(line)
+            continue
+        m = _table_row(line)
+        if m:
+            if builder is None:
+                builder = _ColumnBuilder()
+            cells = m.group('cells')
+            builder.add(None if cells.startswith('-') else
+                        [c.strip() for c in cells.split('|') if c != ''])
+            continue
+        if builder is not None:
+            yield builder.build(numpy)
+            builder = None
+        src_flg = src_begin(line) is not None
+    if builder is not None:
+        yield builder.build(numpy)
@@ -0,0 +1,281 @@
+'''org -> HTML conversion server backed by a pool of warm processes
+
+Protocol: one JSON object per line in each direction.
+request:  {"id": ..., "text": "...", "default_heading": 1, "newline": ""}
+response: {"id": ..., "html": "..."} or {"id": ..., "error": "..."}
+Requests on one connection may be pipelined; responses are written as
+they complete and carry the id of their request.
+'''
+import asyncio
+import json
+import os
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+from threading import Thread
+
+from .org import Limits, org_to_html
+
+
+WARMUP = '''* heading
+paragraph *bold* /italic/ _underlined_ +linethrough+ =code= ~mono~
+[[http://example.com][link]] [[image.png]]
+- item
+1. item
+- term :: description
+| a | b |
+#+BEGIN_QUOTE
+quote
+#+END_QUOTE
+#+BEGIN_SRC python
+code
+#+END_SRC'''
+
+
+_warmed = False
+
+
+def _warm():
+    '''compiles the regexps and the inline dispatch table in a worker
+
+    ^C in a terminal reaches the workers too; they leave it to the
+    server, which shuts the pool down.'''
+    global _warmed
+    if not _warmed:
+        _warmed = True
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        org_to_html(WARMUP)
+
+
+def convert(text, default_heading=1, newline='', limits=None):
+    _warm()
+    return org_to_html(text, default_heading, newline, limits=limits)
+
+
+class Server(object):
+    '''Serves conversion requests through a process pool
+
+    max_pending: requests in flight per connection; no more lines are
+    read from a connection while it has that many, so a client sending
+    faster than the workers convert is slowed down by its socket.
+    timeout: seconds before a request is answered with an error.
+    limits: Limits of every conversion; by default only the timeout, so
+    the worker stops parsing too, and the nesting depth are limited. the
+    worker keeps parsing after a timeout when limits has no timeout.'''
+    def __init__(self, workers=None, max_pending=64, timeout=10.0,
+                 limits=None, max_line=16 * 1024 * 1024):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        if limits is None:
+            limits = Limits(max_line_length=None, max_nodes=None,
+                            max_work=None, timeout=timeout)
+        self.limits = limits
+        self.max_line = max_line
+        # the initializer of ProcessPoolExecutor needs Python 3.7; a
+        # warming job is sent per worker instead, and a worker which
+        # took none warms itself on its first request
+        workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(workers)
+        for _ in range(workers):
+            self.pool.submit(_warm)
+        self.connections = set()
+
+    def _connected(self, reader, writer):
+        '''starts serving a connection, returns its task'''
+        task = asyncio.ensure_future(self.handle(reader, writer))
+        self.connections.add(task)
+        task.add_done_callback(self.connections.discard)
+        return task
+
+    async def handle(self, reader, writer):
+        '''serves the requests read from reader until it is closed'''
+        pending = asyncio.Semaphore(self.max_pending)
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                await pending.acquire()
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await self._write(writer, lock, {
+                        'id': None, 'error': 'request line too long'})
+                    break
+                if not line:
+                    break
+                task = asyncio.ensure_future(
+                    self._respond(line, writer, lock, pending))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _respond(self, line, writer, lock, pending):
+        try:
+            response = await self._convert(line)
+            await self._write(writer, lock, response)
+        except ConnectionError:
+            pass
+        finally:
+            pending.release()
+
+    async def _write(self, writer, lock, response):
+        async with lock:
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+            await writer.drain()
+
+    async def _convert(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+            id_ = request.get('id')
+            args = (request['text'], request.get('default_heading', 1),
+                    request.get('newline', ''), self.limits)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return {'id': None, 'error': 'invalid request: {}'.format(e)}
+        loop = asyncio.get_event_loop()
+        try:
+            html = await asyncio.wait_for(
+                loop.run_in_executor(self.pool, convert, *args),
+                self.timeout)
+        except asyncio.TimeoutError:
+            return {'id': id_, 'error': 'timeout'}
+        except Exception as e:
+            error = e.__class__.__name__
+            if str(e):
+                error += ': ' + str(e)
+            return {'id': id_, 'error': error}
+        return {'id': id_, 'html': html}
+
+    async def start_unix(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        return await asyncio.start_unix_server(
+            self._connected, path, limit=self.max_line)
+
+    async def serve_stdio(self):
+        await self._connected(_StdinReader(self.max_line), _StdoutWriter())
+
+    async def run(self, path, stop):
+        '''serves on the unix socket path, or on stdin/stdout without one,
+        until stop is set or stdin is closed'''
+        waiter = asyncio.ensure_future(stop.wait())
+        if path is None:
+            stdio = asyncio.ensure_future(self.serve_stdio())
+            await asyncio.wait([stdio, waiter],
+                               return_when=asyncio.FIRST_COMPLETED)
+        else:
+            unix_server = await self.start_unix(path)
+            await waiter
+            unix_server.close()
+        waiter.cancel()
+        await self.disconnect()
+        if path is not None:
+            await unix_server.wait_closed()
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def disconnect(self):
+        '''cancels the requests in flight and closes every connection'''
+        connections = list(self.connections)
+        for task in connections:
+            task.cancel()
+        if connections:
+            await asyncio.wait(connections)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class _StdinReader(object):
+    '''reads stdin, which may be a file, in a daemon thread
+
+    the thread does not keep the process alive when the server stops
+    while it waits for input; it reads the file descriptor itself, as
+    sys.stdin must not be locked by a daemon thread at exit.'''
+    def __init__(self, limit):
+        self.limit = limit
+        self._fd = sys.stdin.fileno()
+        self._buffer = bytearray()
+        self._requests = Queue()
+        Thread(target=self._read, daemon=True).start()
+
+    def _readline(self):
+        '''returns a line of at most limit + 1 bytes, b'' at the end'''
+        buffer = self._buffer
+        while True:
+            end = buffer.find(b'\n', 0, self.limit + 1) + 1
+            if not end and len(buffer) > self.limit:
+                end = self.limit + 1
+            if end:
+                line = bytes(buffer[:end])
+                del buffer[:end]
+                return line
+            data = os.read(self._fd, 65536)
+            if not data:
+                line = bytes(buffer)
+                del buffer[:]
+                return line
+            buffer += data
+
+    def _read(self):
+        while True:
+            loop, future = self._requests.get()
+            try:
+                line = self._readline()
+            except Exception as e:
+                loop.call_soon_threadsafe(_settle, future, None, e)
+            else:
+                loop.call_soon_threadsafe(_settle, future, line, None)
+
+    async def readline(self):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._requests.put((loop, future))
+        line = await future
+        if len(line) > self.limit:
+            raise ValueError('line longer than {}'.format(self.limit))
+        return line
+
+
+def _settle(future, result, exception):
+    if future.cancelled():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+class _StdoutWriter(object):
+    '''writes to stdout, which may be a file, like a StreamWriter'''
+    def write(self, data):
+        sys.stdout.buffer.write(data)
+
+    async def drain(self):
+        sys.stdout.buffer.flush()
+
+    def close(self):
+        sys.stdout.buffer.flush()
+
+
+def serve(path=None, **options):
+    '''serves on the unix socket path, or on stdin/stdout without one
+
+    SIGTERM and SIGINT stop the server; the worker processes are shut
+    down before it returns.'''
+    server = Server(**options)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        loop.run_until_complete(server.run(path, stop))
+    finally:
+        server.close()
+        loop.close()
@@ -0,0 +1,210 @@
+'''Incremental org -> HTML rebuilds of a directory'''
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from re import compile
+from time import monotonic, sleep
+
+from .org import BaseError, Org, Syntax
+
+
+HEADING = compile(Syntax.HEADING)
+SRC_BEGIN = compile(Syntax.SRC_BEGIN)
+SRC_END = compile(Syntax.SRC_END)
+
+
+def split_sections(text):
+    '''splits text into the preamble and the top level heading sections
+
+    a top level heading is one not nested under an earlier heading, so
+    every section of a well formed document parses into exactly the
+    nodes it has in the whole document. heading lines inside source
+    blocks do not split; a quote block left open across a heading does,
+    and the sections it spans fail to parse on their own.'''
+    sections = []
+    lines = []
+    levels = []
+    src_flg = False
+    for line in text.splitlines():
+        if src_flg:
+            src_flg = not SRC_END.match(line)
+        elif SRC_BEGIN.match(line):
+            src_flg = True
+        else:
+            m = HEADING.match(line)
+            if m:
+                level = len(m.group('level'))
+                while levels and levels[-1] >= level:
+                    levels.pop()
+                if not levels:
+                    sections.append('\n'.join(lines))
+                    lines = []
+                levels.append(level)
+        lines.append(line)
+    sections.append('\n'.join(lines))
+    return sections
+
+
+class Section(object):
+    '''Parsed and rendered section of a document'''
+    def __init__(self, text, default_heading=1, newline=''):
+        self.text = text
+        self.org = Org(text, default_heading)
+        self.html = self.org.html(newline)
+
+
+class Document(object):
+    '''Org document which re-converts only changed sections'''
+    def __init__(self, default_heading=1, newline=''):
+        self.default_heading = default_heading
+        self.newline = newline
+        self.sections = []
+
+    def update(self, text):
+        '''parses text reusing unchanged sections
+
+        when a section fails to parse on its own, the whole text is
+        parsed as one section, which raises only where Org does.
+        returns the number of sections converted.'''
+        previous = {section.text: section for section in self.sections}
+        sections = []
+        converted = 0
+        try:
+            for part in split_sections(text):
+                section = previous.get(part)
+                if section is None:
+                    section = Section(part, self.default_heading,
+                                      self.newline)
+                    converted += 1
+                sections.append(section)
+        except BaseError:
+            sections = None
+        if sections is None:
+            section = previous.get(text)
+            converted = 0
+            if section is None:
+                section = Section(text, self.default_heading, self.newline)
+                converted = 1
+            sections = [section]
+        self.sections = sections
+        return converted
+
+    def html(self):
+        return self.newline.join(
+            [section.html for section in self.sections
+             if section.org.children])
+
+
+class Site(object):
+    '''Directory of org files converted to HTML files
+
+    files are converted by a pool of threads, as the Documents keeping
+    their parsed sections live in this process. conversion is CPU bound,
+    so under the GIL the threads only overlap reading and writing the
+    files; on a free-threaded build they convert in parallel.'''
+    def __init__(self, src, dest, default_heading=1, newline='', workers=4):
+        self.src = src
+        self.dest = dest
+        self.default_heading = default_heading
+        self.newline = newline
+        self.documents = {}
+        self.stats = {}
+        self.pool = ThreadPoolExecutor(workers)
+
+    def scan(self):
+        '''returns {path: (mtime, size)} of the org files under src'''
+        stats = {}
+        for root, _, files in os.walk(self.src):
+            for name in files:
+                if name.endswith('.org'):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    stats[path] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def poll(self):
+        '''returns the set of paths changed, added or removed since the
+        last poll'''
+        stats = self.scan()
+        changed = set(path for path, stat in stats.items()
+                      if self.stats.get(path) != stat)
+        changed.update(set(self.stats) - set(stats))
+        self.stats = stats
+        return changed
+
+    def output_path(self, path):
+        rel = os.path.relpath(path, self.src)
+        return os.path.join(self.dest, os.path.splitext(rel)[0] + '.html')
+
+    def build(self, path):
+        '''converts one file, returns (sections converted, seconds)'''
+        start = monotonic()
+        output = self.output_path(path)
+        if not os.path.exists(path):
+            self.documents.pop(path, None)
+            if os.path.exists(output):
+                os.remove(output)
+            return 0, monotonic() - start
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        document = self.documents.get(path)
+        if document is None:
+            document = self.documents[path] = Document(
+                self.default_heading, self.newline)
+        converted = document.update(text)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(document.html())
+        return converted, monotonic() - start
+
+    def rebuild(self, paths):
+        '''converts paths through the worker pool
+
+        returns {path: (sections converted, seconds)}, or the exception
+        raised while converting the path.'''
+        paths = sorted(paths)
+        futures = [self.pool.submit(self.build, path) for path in paths]
+        results = {}
+        for path, future in zip(paths, futures):
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                results[path] = e
+        return results
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def watch(site, interval=0.5, debounce=0.1, log=sys.stderr):
+    '''polls site.src every interval seconds and rebuilds changed files
+
+    changes are batched until no file changed for debounce seconds.
+    the latency from detecting a change to the rebuilt file is logged.'''
+    while True:
+        changed = site.poll()
+        if not changed:
+            sleep(interval)
+            continue
+        detected = monotonic()
+        while True:
+            sleep(debounce)
+            more = site.poll()
+            if not more:
+                break
+            changed |= more
+        results = site.rebuild(changed)
+        for path, result in sorted(results.items()):
+            if isinstance(result, Exception):
+                log.write('{}: {}: {}\n'.format(
+                    path, result.__class__.__name__, result))
+            else:
+                converted, seconds = result
+                log.write('{}: {} sections converted in {:.1f} ms\n'.format(
+                    path, converted, seconds * 1000))
+        log.write('rebuilt {} files, {:.1f} ms after the change\n'.format(
+            len(results), (monotonic() - detected) * 1000))
+        log.flush()
@@ -1,9 +1,27 @@
+import asyncio
+import gc
+import json
+import os
 import nose
-from nose.tools import eq_, raises
+import signal
+import subprocess
+import sys
+import time
+import tracemalloc
+from nose.tools import eq_, ok_, raises
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
-from pyorg.org import NestingNotValidError
-from pyorg.org import Org, org_to_html
+from pyorg.org import NestingNotValidError, LimitExceededError, Limits
+from pyorg.org import Org, org_to_html, org_to_html_many
+from pyorg.org import Text, TerminalNode, InlineCache, iter_tables
+from pyorg.org import LazyOrg, TocEntry, slugify, Parser
+from pyorg.org import LinkRecord, extract_links
+from pyorg.diff import Patch, apply, diff, fragments
+from pyorg.diff import keyed, source_keys, units
+from pyorg.server import Server
+from pyorg.watch import Document, Site, split_sections
 
 class TestOrg(TestCase):
     def test_org(self):
@@ -234,6 +252,101 @@ source code
         eq_(str(o), 'Org(Paragraph(Text))')
         eq_(o.children[0].children[0].get_text(), 'hogeInlineCodeTextfuga')
 
+    def test_registered_inline_syntax(self):
+        class FootnoteReference(Text):
+            def __init__(self, label):
+                self.label = label
+                super().__init__(label)
+
+            def _get_open(self):
+                return '<sup>'
+
+            def _get_close(self):
+                return '</sup>'
+
+        original = TerminalNode.inline_syntax
+        registry = original.copy()
+        registry.register('footnote', r'\[fn:(?P<label>[^\]]+)\]', '[',
+                          FootnoteReference)
+        TerminalNode.inline_syntax = registry
+        try:
+            o = Org('''hoge[fn:1]fuga*[fn:2]*''')
+            registry.register('verbatim', r'!(?P<text>[^!]+)!', '!', Text,
+                              before='bold')
+            eq_(Org('*!a*b!*').children[0].children[0].get_text(), '*Text*')
+        finally:
+            TerminalNode.inline_syntax = original
+        eq_(o.children[0].children[0].get_text(),
+            'hogeFootnoteReferencefugaBoldText')
+        eq_(o.html(), '<p>hoge<sup>1</sup>fuga<span style="font-weight: bold;"><sup>2</sup></span></p>')
+        o = Org('''hoge[fn:1]fuga''')
+        eq_(o.children[0].children[0].get_text(), 'hoge[fn:1]fuga')
+
+    def test_plain_text_fast_path(self):
+        texts = ['plain text only', 'a lone * star', 'x = y', '1/2 and 3/4',
+                 'snake_case', 'a + b', '~ tilde', '[ bracket ]', '[[half',
+                 'a *bold* b', '=code= and /italic/', 'x [[http://a][b]] y',
+                 '- item with *b*', '| a | b* |', '< & >', '']
+        registry = TerminalNode.inline_syntax
+        ok_(not registry.has_markup('plain text only'))
+        ok_(registry.has_markup('a lone * star'))
+        fast = [org_to_html(text) for text in texts]
+        registry.has_markup = lambda value: True
+        try:
+            eq_([org_to_html(text) for text in texts], fast)
+            registry.candidates = lambda value: registry.syntaxes
+            eq_([org_to_html(text) for text in texts], fast)
+        finally:
+            del registry.has_markup
+            registry.__dict__.pop('candidates', None)
+        eq_(fast[0], '<p>plain text only</p>')
+        eq_(fast[1], '<p>a lone * star</p>')
+        eq_(fast[2], '<p>x = y</p>')
+
+    def test_intern(self):
+        text = '''* h1
+- *item*
+- *item*
+* h2
+|*item*|*item*|
+* h3
+*item*'''
+        o = Org(text, intern=True)
+        items = o.children[0].children[0].children
+        cells = [cell.children[0]
+                 for cell in o.children[1].children[0].children[0].children]
+        para = o.children[2].children[0].children[0]
+        ok_(items[0].values is items[1].values)
+        ok_(cells[0].values is items[0].values)
+        ok_(cells[1].values is items[0].values)
+        ok_(para.values is items[0].values)
+        eq_(o.cache.misses, 1)
+        eq_(o.html(), Org(text).html())
+
+    def test_shared_intern_cache(self):
+        cache = InlineCache(maxsize=2)
+        o1 = Org('a /b/', intern=cache)
+        o2 = Org('a /b/', intern=cache)
+        ok_(o1.children[0].children[0].values is
+            o2.children[0].children[0].values)
+        Org('''c
+d''', intern=cache)
+        eq_(len(cache), 2)
+        o3 = Org('a /b/', intern=cache)
+        ok_(o1.children[0].children[0].values is not
+            o3.children[0].children[0].values)
+
+    def test_interned_values_frozen(self):
+        cache = InlineCache()
+        o = Org('a *b /c/* [[http://d][e]]', intern=cache)
+        values = o.children[0].children[0].values
+        bold = values[1]
+        ok_(isinstance(bold.values, tuple))
+        ok_(isinstance(bold.values[1].values, tuple))
+        ok_(isinstance(values[3].values, tuple))
+        with self.assertRaises(AttributeError):
+            bold.values.append('x')
+
     def test_mix(self):
         text = '''* header1
 paraparapara
@@ -307,6 +420,24 @@ quoted
         o = Org(text)
         eq_(o.html(), '<p><code>&lt;tag&gt;</code></p>')
 
+    def test_escape(self):
+        text = '''* a < b
+<script>alert("x" & 'y')</script>
+[[http://example.com/?q="a&b"][a & b]]
+[[pic.png][<alt>]]'''
+        o = Org(text)
+        eq_(o.html(), '<h1>a &lt; b</h1><p>&lt;script&gt;alert(&quot;x&quot; &amp; &#x27;y&#x27;)&lt;/script&gt;<a href="http://example.com/?q=&quot;a&amp;b&quot;">a &amp; b</a><img src="pic.png" alt="&lt;alt&gt;"></p>')
+
+    def test_escape_block_attributes(self):
+        text = '''#+BEGIN_QUOTE: http://example.com/?a="1"
+quoted
+#+END_QUOTE
+#+BEGIN_SRC c"><script>
+if (a < b && c) {}
+#+END_SRC'''
+        o = Org(text)
+        eq_(o.html(), '<blockquote cite="http://example.com/?a=&quot;1&quot;">quoted</blockquote><pre><code class="c&quot;&gt;&lt;script&gt;">if (a &lt; b &amp;&amp; c) {}</code></pre>')
+
 class TestOrgToHTMLFunction(TestCase):
     def test_html(self):
         text = '''* header1
@@ -351,6 +482,710 @@ hogehogehoge
 - list2'''
         eq_(org_to_html(text, newline='\n'), '<h1>header1</h1><p>paraparapara\nhogehogehoge</p><ul><li>list1</li><li>list2</li></ul>')
 
+    def test_many(self):
+        texts = ['', 'one *line*', 'two\n  lines < 3 ', '* heading',
+                 '*bold* start', '- item', '2024 was\n\nfine', '| a |',
+                 '#+BEGIN_QUOTE\nq\n#+END_QUOTE', 'one\r\n2. item']
+        for options in ({}, {'newline': '\n', 'default_heading': 2},
+                        {'intern': True, 'anchors': True},
+                        {'limits': Limits()}):
+            eq_(list(org_to_html_many(texts, **options)),
+                [org_to_html(text, **options) for text in texts])
+
+    def test_many_limits(self):
+        texts = org_to_html_many(['short', 'x' * 20], limits=Limits(
+            max_line_length=10))
+        eq_(next(texts), '<p>short</p>')
+        with self.assertRaises(LimitExceededError):
+            next(texts)
+
+
+class TestLazyOrg(TestCase):
+    text = '''preamble
+** header2
+para
+* header1
+#+BEGIN_SRC org
+* not a header
+#+END_SRC
+** header2
+| a | b |
+*** header3
+- item
+* header1'''
+
+    def test_lazy(self):
+        o = LazyOrg(self.text)
+        eq_(str(o), str(Org(self.text)))
+        eq_(o.html(), Org(self.text).html())
+        o = LazyOrg(self.text, default_heading=2)
+        eq_(o.html('\n'), Org(self.text, default_heading=2).html('\n'))
+
+    def test_headings_without_parsing(self):
+        o = LazyOrg(self.text)
+        eq_([(h.depth, h.title) for h in o.headings()],
+            [(2, 'header2'), (1, 'header1'), (2, 'header2'),
+             (3, 'header3'), (1, 'header1')])
+        eq_([(h.depth, h.title) for h in o.headings()],
+            [(h.depth, h.title) for h in Org(self.text).headings()])
+        ok_(o._preamble is None)
+        ok_(all(h._children is None for h in o.headings()))
+
+    def test_blocks(self):
+        o = LazyOrg(self.text)
+        blocks = o.blocks()
+        eq_(str(next(blocks)), 'Paragraph(Text)')
+        heading = next(blocks)
+        eq_(heading.title, 'header2')
+        ok_(heading._children is None)
+        eq_(str(heading), 'Heading2(Paragraph(Text))')
+        eq_([b.title for b in blocks], ['header1', 'header1'])
+        ok_(list(o.headings())[1]._children is None)
+
+
+class TestParser(TestCase):
+    text = '''* header1
+para *bold* and [[http://example.com][link]]
+- item
+| a | *b* |'''
+
+    def test_parse(self):
+        parser = Parser(default_heading=2, anchors=True)
+        o = parser.parse(self.text)
+        eq_(str(o), str(Org(self.text, 2)))
+        eq_(o.html(), org_to_html(self.text, 2, anchors=True))
+        eq_(parser.html(self.text, '\n'),
+            org_to_html(self.text, 2, '\n', anchors=True))
+
+    def test_frozen(self):
+        o = Parser().parse(self.text)
+        ok_(isinstance(o.children, tuple))
+        ok_(isinstance(o.toc, tuple))
+        heading = o.children[0]
+        ok_(isinstance(heading.children, tuple))
+        ok_(isinstance(heading.children[0].children[0].values, tuple))
+        ok_(not hasattr(o, 'current'))
+        with self.assertRaises(AttributeError):
+            o.append('text')
+
+    def test_no_list_reachable(self):
+        def lists(value, seen):
+            if id(value) in seen or isinstance(value, (str, int, type)):
+                return []
+            seen.add(id(value))
+            found = [value] if isinstance(value, list) else []
+            if isinstance(value, (list, tuple)):
+                items = value
+            elif isinstance(value, dict):
+                items = list(value.values())
+            elif hasattr(value, '__dict__'):
+                # the parent is walked already, the cache is not in the tree
+                items = [v for k, v in vars(value).items()
+                         if k not in ('parent', 'cache')]
+            else:
+                items = []
+            for item in items:
+                found.extend(lists(item, seen))
+            return found
+
+        text = self.text + '\n*/a/* and *[[http://x][y]]*'
+        for parser in (Parser(), Parser(intern=True)):
+            parser.parse(text)
+            eq_(lists(parser.parse(text), set()), [])
+
+    def test_threads(self):
+        parser = Parser(intern=InlineCache(maxsize=8))
+        texts = [self.text.replace('1', str(i)) for i in range(50)] * 4
+        with ThreadPoolExecutor(4) as pool:
+            htmls = list(pool.map(parser.html, texts))
+        eq_(htmls, [org_to_html(text) for text in texts])
+
+
+class TestToc(TestCase):
+    text = '''* Intro
+** Set up
+*** Deep
+** Set up
+* Set up-2
+* Set up
+** 日本語 タイトル'''
+
+    def test_slugify(self):
+        eq_(slugify('Hello, World!'), 'hello-world')
+        eq_(slugify('snake_case =code='), 'snake-case-code')
+        eq_(slugify('日本語 タイトル'), '日本語-タイトル')
+        eq_(slugify('***'), 'section')
+
+    def test_toc(self):
+        toc = [
+            TocEntry(1, 'Intro', 'intro'),
+            TocEntry(2, 'Set up', 'set-up'),
+            TocEntry(3, 'Deep', 'deep'),
+            TocEntry(2, 'Set up', 'set-up-2'),
+            TocEntry(1, 'Set up-2', 'set-up-2-2'),
+            TocEntry(1, 'Set up', 'set-up-3'),
+            TocEntry(2, '日本語 タイトル', '日本語-タイトル'),
+        ]
+        eq_(Org(self.text).toc, toc)
+        eq_(LazyOrg(self.text).toc, toc)
+
+    def test_anchors(self):
+        eq_(org_to_html('* a\n* a', anchors=True),
+            '<h1 id="a">a</h1><h1 id="a-2">a</h1>')
+        eq_(org_to_html('* a\n* a'), '<h1>a</h1><h1>a</h1>')
+        eq_(LazyOrg('* a\n* a', anchors=True).html(),
+            '<h1 id="a">a</h1><h1 id="a-2">a</h1>')
+
+    def test_toc_html(self):
+        eq_(Org(self.text).toc_html(), '<ul><li><a href="#intro">Intro</a><ul><li><a href="#set-up">Set up</a><ul><li><a href="#deep">Deep</a></li></ul></li><li><a href="#set-up-2">Set up</a></li></ul></li><li><a href="#set-up-2-2">Set up-2</a></li><li><a href="#set-up-3">Set up</a><ul><li><a href="#日本語-タイトル">日本語 タイトル</a></li></ul></li></ul>')
+        eq_(Org('** a\n* b').toc_html(), '<ul><li><a href="#a">a</a></li><li><a href="#b">b</a></li></ul>')
+        eq_(Org('text').toc_html(), '')
+
+
+class TestLinks(TestCase):
+    text = '''* [[http://heading.com][heading]]
+text [[http://a.com][a]] and [[b.png]] and *[[http://c.com]]*
+=[[http://code.com]]=
+#+BEGIN_SRC org
+[[http://src.com]]
+#+END_SRC
+- [[http://item.com][item]] :: [[d.png][alt]]
+| [[http://cell.com]] | x |'''
+
+    def test_extract_links(self):
+        eq_(list(extract_links(self.text)), [
+            LinkRecord('http://a.com', 'a', 2),
+            LinkRecord('b.png', None, 2),
+            LinkRecord('http://c.com', None, 2),
+            LinkRecord('http://item.com', 'item', 7),
+            LinkRecord('d.png', 'alt', 7),
+            LinkRecord('http://cell.com', None, 8),
+        ])
+
+    def test_extract_links_lines(self):
+        for end in ('\n', '\r\n'):
+            lines = [line + end for line in self.text.splitlines()]
+            eq_(list(extract_links(iter(lines))),
+                list(extract_links(self.text)))
+        lines = ['#+BEGIN_SRC\r\n', '[[http://x]]\r\n', '#+END_SRC\r\n']
+        eq_(list(extract_links(lines)), [])
+
+
+class TestDiff(TestCase):
+    text = '''preamble
+* header1
+para
+** header2
+- item
+* header3
+| a | b |'''
+
+    def test_fragments(self):
+        o = Org(self.text)
+        eq_(fragments(o), ['<p>preamble</p>', '<h1>header1</h1><p>para</p>',
+                           '<h2>header2</h2><ul><li>item</li></ul>',
+                           '<h1>header3</h1><table><tr><td>a</td>'
+                           '<td>b</td></tr></table>'])
+        eq_(''.join(fragments(o, '\n')), o.html('\n'))
+
+    def test_diff(self):
+        old = Org(self.text)
+        eq_(diff(old, Org(self.text)), [])
+        new = Org(self.text.replace('para', 'changed'))
+        eq_(diff(old, new), [
+            Patch('replace', 1, 2, ['<h1>header1</h1><p>changed</p>'])])
+        new = Org(self.text.replace('* header3', '* new\n* header3'))
+        eq_(diff(old, new), [Patch('insert', 3, 3, ['<h1>new</h1>'])])
+        new = Org(self.text.replace('** header2\n- item\n', ''))
+        eq_(diff(old, new), [Patch('delete', 2, 3, [])])
+
+    def test_apply(self):
+        old = Org(self.text)
+        new = Org('* header0\n' + self.text.replace('- item', '1. one') +
+                  '\nend')
+        for newline in ('', '\n'):
+            patched = apply(fragments(old, newline),
+                            diff(old, new, newline))
+            eq_(patched, fragments(new, newline))
+            eq_(''.join(patched), new.html(newline))
+
+    def test_source_keys(self):
+        old = Org(self.text)
+        eq_(len(source_keys(old, units(old))), 4)
+        new = Org(self.text.replace(
+            '* header3', '#+BEGIN_SRC\n* code\n#+END_SRC\n* header3'))
+        eq_(source_keys(new, units(new))[:2], source_keys(old, units(old))[:2])
+        eq_(diff(old, new), [Patch('replace', 2, 3, fragments(new)[2:3])])
+
+    def test_block_after_heading(self):
+        # a heading parsed in a table cell leaves the table at the top
+        o = Org('text\n* h\nx :: y\n|** c|\n| a | b |')
+        eq_(units(o)[-1].heading, None)
+        eq_(source_keys(o, units(o)), None)
+        eq_(''.join(fragments(o, '\n')), o.html('\n'))
+
+    def test_frozen_keyed_once(self):
+        old = Parser().parse(self.text)
+        diff(old, Org(self.text))
+        kept = keyed(old)
+        ok_(keyed(old)[0] is kept[0])
+        new = Org(self.text)
+        ok_(keyed(new)[0] is not keyed(new)[0])
+
+
+class TestColumns(TestCase):
+    text = '''| name | count | ratio |
+|------+-------+-------|
+| a    |     1 |   0.5 |
+| *b*  |    -2 |     1 |
+| c    |     3 |
+#+BEGIN_SRC org
+| not | a | table |
+#+END_SRC
+|x|1|'''
+
+    def test_tables(self):
+        tables = Org(self.text).tables()
+        eq_(len(tables), 2)
+        table = tables[0]
+        eq_(len(table), 3)
+        eq_(table.names, ['name', 'count', 'ratio'])
+        eq_(table['name'], ['a', '*b*', 'c'])
+        eq_(table['count'].typecode, 'q')
+        eq_(list(table['count']), [1, -2, 3])
+        eq_(table['ratio'], ['0.5', '1', ''])
+        eq_(tables[1].names, None)
+        eq_(tables[1][0], ['x'])
+        eq_(list(tables[1][1]), [1])
+
+    def test_iter_tables_lines(self):
+        lines = ['| a | 1.5 |\n', '| b | 2 |\n', 'text\n', '| c |\n']
+        tables = list(iter_tables(iter(lines)))
+        eq_(len(tables), 2)
+        eq_(tables[0][1].typecode, 'd')
+        eq_(list(tables[0][1]), [1.5, 2.0])
+        eq_(tables[1][0], ['c'])
+
+    def test_to_columns(self):
+        text = '''| name | count |
+|------+-------|
+| a    |     1 |
+| *b*  |     2 |'''
+        o = Org(text)
+        table = o.children[0].to_columns()
+        eq_(table.names, ['name', 'count'])
+        eq_(table['name'], ['a', '*b*'])
+        eq_(list(table['count']), [1, 2])
+        eq_(table['name'], o.tables()[0]['name'])
+
+    def test_border_rules(self):
+        text = '''|------+---|
+| name | n |
+|------+---|
+| a    | 1 |
+| b    | 2 |
+|------+---|'''
+        for table in (Org(text).tables()[0],
+                      Org(text).children[0].to_columns()):
+            eq_(table.names, ['name', 'n'])
+            eq_(table['name'], ['a', 'b'])
+            eq_(table['n'].typecode, 'q')
+            eq_(list(table['n']), [1, 2])
+
+    def test_rules_of_cells(self):
+        table = list(iter_tables('| h | n |\n|---|---|\n| a | -1 |'))[0]
+        eq_(table.names, ['h', 'n'])
+        eq_(list(table['n']), [-1])
+        table = list(iter_tables('| a |\n| b |\n|---|\n| c |'))[0]
+        eq_(table.names, None)
+        eq_(table[0], ['a', 'b', 'c'])
+
+    def test_placeholder_cells(self):
+        text = '| name | score |\n|---+---|\n| a | 1 |\n| - | - |\n| c | 3 |'
+        for table in (list(iter_tables(text))[0],
+                      Org(text).children[0].to_columns()):
+            eq_(table.names, ['name', 'score'])
+            eq_(table['name'], ['a', '-', 'c'])
+            eq_(table['score'], ['1', '-', '3'])
+
+    def test_strict_numbers(self):
+        text = ('| nan | 1_000 | 12345678901234567890123 | 1e3 |\n'
+                '| inf | 2     | 1                       | .5  |')
+        table = Org(text).tables()[0]
+        eq_(table[0], ['nan', 'inf'])
+        eq_(table[1], ['1_000', '2'])
+        eq_(table[2], ['12345678901234567890123', '1'])
+        eq_(table[3].typecode, 'd')
+        eq_(list(table[3]), [1000.0, 0.5])
+
+    def test_key_without_names(self):
+        table = Org('| a |').tables()[0]
+        with self.assertRaises(KeyError):
+            table['a']
+
+
+class TestServer(TestCase):
+    def _requests(self, server, requests):
+        '''sends requests and a line of garbage to server on a unix
+        socket, returns the responses by id'''
+        async def run(path):
+            reader, writer = await asyncio.open_unix_connection(path)
+            for request in requests:
+                writer.write(json.dumps(request).encode() + b'\n')
+            writer.write(b'not json\n')
+            writer.write_eof()
+            responses = []
+            for _ in range(len(requests) + 1):
+                responses.append(json.loads((await reader.readline()).decode()))
+            writer.close()
+            return responses
+
+        loop = asyncio.new_event_loop()
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sock')
+            try:
+                unix_server = loop.run_until_complete(server.start_unix(path))
+                responses = loop.run_until_complete(run(path))
+                unix_server.close()
+                loop.run_until_complete(unix_server.wait_closed())
+            finally:
+                server.close()
+                loop.close()
+        return {r['id']: r for r in responses}
+
+    def test_pipelined_requests(self):
+        requests = [
+            {'id': 1, 'text': '* a\n*b*'},
+            {'id': 2, 'text': 'x\ny', 'newline': '\n'},
+            {'id': 3, 'text': '#+BEGIN_QUOTE'},
+            {'id': 4, 'text': 'a' * 100},
+        ]
+        server = Server(workers=2, max_pending=2,
+                        limits=Limits(max_line_length=50))
+        responses = self._requests(server, requests)
+        eq_(responses[1], {'id': 1, 'html': org_to_html('* a\n*b*')})
+        eq_(responses[2], {'id': 2, 'html': '<p>x\ny</p>'})
+        eq_(responses[3], {'id': 3, 'error': 'NestingNotValidError'})
+        eq_(responses[4], {'id': 4, 'error': 'LimitExceededError: '
+                           'max_line_length of 50 exceeded'})
+        ok_(responses[None]['error'].startswith('invalid request'))
+
+    def test_default_limits(self):
+        long_line = 'word ' * 5000
+        responses = self._requests(Server(workers=1), [
+            {'id': 1, 'text': long_line}])
+        eq_(responses[1], {'id': 1, 'html': org_to_html(long_line)})
+
+    def test_timeout(self):
+        slow = '* heading\npara *bold* /italic/\n' * 50000
+        responses = self._requests(Server(workers=1, timeout=0.5), [
+            {'id': 1, 'text': slow}])
+        ok_(responses[1]['error'] in (
+            'timeout', 'LimitExceededError: timeout of 0.5 exceeded'))
+
+    def _children(self, pid):
+        '''returns the pids of the processes whose parent is pid'''
+        children = []
+        for name in os.listdir('/proc'):
+            try:
+                with open('/proc/{}/stat'.format(name)) as f:
+                    stat = f.read()
+            except (IOError, OSError):
+                continue
+            if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+                children.append(int(name))
+        return children
+
+    def _alive(self, pids, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            alive = [pid for pid in pids
+                     if os.path.exists('/proc/{}'.format(pid))]
+            if not alive:
+                break
+            time.sleep(0.05)
+        return alive
+
+    def _check_terminate(self, args, request, signum):
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'pyorg', 'serve', '--workers', '2'] + args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            request(server)
+            workers = self._children(server.pid)
+            eq_(len(workers), 2)
+            server.send_signal(signum)
+            eq_(server.wait(10), 0)
+            eq_(self._alive(workers), [])
+        finally:
+            if server.poll() is None:
+                server.kill()
+                server.wait()
+            server.stdin.close()
+            server.stdout.close()
+
+    def test_terminate_unix(self):
+        if not os.path.isdir('/proc'):
+            self.skipTest('needs /proc')
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sock')
+
+            def request(server):
+                deadline = time.monotonic() + 10
+                while not os.path.exists(path):
+                    ok_(time.monotonic() < deadline)
+                    time.sleep(0.05)
+
+                async def run():
+                    reader, writer = await asyncio.open_unix_connection(path)
+                    writer.write(b'{"id": 1, "text": "a"}\n')
+                    eq_(json.loads((await reader.readline()).decode()),
+                        {'id': 1, 'html': '<p>a</p>'})
+                    writer.close()
+
+                loop = asyncio.new_event_loop()
+                try:
+                    loop.run_until_complete(run())
+                finally:
+                    loop.close()
+
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                self._check_terminate(['--socket', path], request, signum)
+                ok_(not os.path.exists(path))
+
+    def test_terminate_stdio(self):
+        if not os.path.isdir('/proc'):
+            self.skipTest('needs /proc')
+
+        def request(server):
+            server.stdin.write(b'{"id": 1, "text": "a"}\n')
+            server.stdin.flush()
+            eq_(json.loads(server.stdout.readline().decode()),
+                {'id': 1, 'html': '<p>a</p>'})
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self._check_terminate([], request, signum)
+
+
+class TestLimits(TestCase):
+    def test_no_limit_exceeded(self):
+        text = '''* header1
+- hoge
+- fuga
+| a | b |'''
+        eq_(org_to_html(text, limits=Limits()), org_to_html(text))
+
+    def test_max_line_length(self):
+        Org('a' * 10, limits=Limits(max_line_length=10))
+        with self.assertRaises(LimitExceededError) as cm:
+            Org('a' * 11, limits=Limits(max_line_length=10))
+        eq_(cm.exception.limit, 'max_line_length')
+
+    def test_max_depth(self):
+        text = '\n'.join(' ' * i + '- item' for i in range(10))
+        Org(text, limits=Limits(max_depth=10))
+        with self.assertRaises(LimitExceededError) as cm:
+            Org(text, limits=Limits(max_depth=9))
+        eq_(cm.exception.limit, 'max_depth')
+
+    def test_max_nodes(self):
+        text = '\n\n'.join(['para'] * 10)
+        Org(text, limits=Limits(max_nodes=30))
+        with self.assertRaises(LimitExceededError) as cm:
+            Org(text, limits=Limits(max_nodes=29))
+        eq_(cm.exception.limit, 'max_nodes')
+
+    def test_max_work(self):
+        text = '\n'.join(['line'] * 10)
+        Org(text, limits=Limits(max_work=50))
+        with self.assertRaises(LimitExceededError) as cm:
+            Org(text, limits=Limits(max_work=49))
+        eq_(cm.exception.limit, 'max_work')
+
+    def test_timeout(self):
+        with self.assertRaises(LimitExceededError) as cm:
+            Org('line\n' * 10, limits=Limits(timeout=-1))
+        eq_(cm.exception.limit, 'timeout')
+
+    def test_lazy_heading_line(self):
+        text = '* ' + 'x' * 200 + '\ntext'
+        with self.assertRaises(LimitExceededError) as cm:
+            LazyOrg(text, limits=Limits(max_line_length=100))
+        eq_(cm.exception.limit, 'max_line_length')
+
+    def test_lazy_whole_document(self):
+        text = ''.join('* h{}\n'.format(i) + 'body line\n' * 5
+                       for i in range(10))
+        for limits, limit in ((Limits(max_work=len(text) - 20), 'max_work'),
+                              (Limits(max_nodes=119), 'max_nodes')):
+            org = LazyOrg(text, limits=limits)
+            with self.assertRaises(LimitExceededError):
+                Org(text, limits=limits)
+            with self.assertRaises(LimitExceededError) as cm:
+                org.html()
+            eq_(cm.exception.limit, limit)
+        deep = '* a\n** b\n- item'
+        with self.assertRaises(LimitExceededError) as cm:
+            LazyOrg(deep, limits=Limits(max_depth=2)).html()
+        eq_(cm.exception.limit, 'max_depth')
+        Org(deep, limits=Limits(max_depth=3))
+        LazyOrg(deep, limits=Limits(max_depth=3)).html()
+
+    def test_pathological_lines(self):
+        # each of these used to take seconds or more to match
+        Org('|' + 'a|' * 50 + 'x')
+        Org('- ' + ' ' * 5000 + 'x')
+        Org('[[http://' * 5000)
+        Org('a*b ' * 5000)
+
+    def test_empty_table_rows(self):
+        # the linear TABLE_ROW matches rows without cells, which are text
+        eq_(org_to_html('||'), '<p>||</p>')
+        eq_(org_to_html('|||'), '<p>|||</p>')
+        eq_(org_to_html('a\n||\nb'), '<p>a||b</p>')
+        eq_(org_to_html('| |'), '<table><tr><td></td></tr></table>')
+        eq_(list(iter_tables('||\n|||')), [])
+
+def measure(func):
+    '''returns (result, peak bytes, live blocks) of calling func under
+    tracemalloc'''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        blocks = sum(stat.count for stat in
+                     tracemalloc.take_snapshot().statistics('filename'))
+        return result, peak, blocks
+    finally:
+        tracemalloc.stop()
+
+
+def memory_document(sections):
+    return '''* Heading {0}
+paragraph text with some words in it
+paragraph text with *bold* and /italic/ and =code=
+** Sub heading {0}
+- item [[http://example.com/{0}][link {0}]]
+- item [[picture{0}.png]]
+| a {0} | b | c |
+| 1 | 2 | 3 |
+
+#+BEGIN_SRC python
+if a < b and b > c: pass
+#+END_SRC
+''' * sections
+
+
+class TestMemory(TestCase):
+    '''budgets for peak traced bytes per source byte and live blocks per
+    line; they have about 50% headroom over the measured values'''
+    text = memory_document(200)
+    lines = text.count('\n')
+
+    def setUp(self):
+        if tracemalloc.is_tracing():
+            self.skipTest('tracemalloc is already tracing')
+
+    def test_parse(self):
+        _, peak, blocks = measure(lambda: Org(self.text))
+        ok_(peak / len(self.text) < 40, peak / len(self.text))
+        ok_(blocks / self.lines < 18, blocks / self.lines)
+
+    def test_html(self):
+        o = Org(self.text)
+        html, peak, _ = measure(o.html)
+        ok_(peak / len(self.text) < 6, peak / len(self.text))
+
+    def test_lazy_headings(self):
+        _, peak, blocks = measure(
+            lambda: [h.title for h in LazyOrg(self.text).headings()])
+        ok_(peak / len(self.text) < 7, peak / len(self.text))
+        ok_(blocks / self.lines < 3, blocks / self.lines)
+
+    def test_iter_tables(self):
+        lines = self.text.splitlines(True)
+        _, peak, _ = measure(lambda: sum(1 for _ in iter_tables(lines)))
+        ok_(peak < 16 * 1024, peak)
+
+    def test_scaling(self):
+        small = memory_document(50)
+        _, small_peak, _ = measure(lambda: Org(small))
+        _, large_peak, _ = measure(lambda: Org(self.text))
+        ratio = (large_peak / len(self.text)) / (small_peak / len(small))
+        ok_(ratio < 1.25, ratio)
+
+class TestWatch(TestCase):
+    text = '''preamble
+** header2
+para
+* header1
+#+BEGIN_SRC org
+* not a header
+#+END_SRC
+** header2
+* header1'''
+
+    def test_split_sections(self):
+        eq_(split_sections(self.text), [
+            'preamble',
+            '** header2\npara',
+            '* header1\n#+BEGIN_SRC org\n* not a header\n#+END_SRC\n** header2',
+            '* header1'])
+
+    def test_document_update(self):
+        document = Document()
+        eq_(document.update(self.text), 4)
+        eq_(document.html(), org_to_html(self.text))
+        text = self.text.replace('para', 'changed')
+        eq_(document.update(text), 1)
+        eq_(document.html(), org_to_html(text))
+        eq_(document.update(text), 0)
+
+    def test_document_update_fallback(self):
+        text = '#+BEGIN_QUOTE\na\n* h\n#+BEGIN_QUOTE\nb\n#+END_QUOTE'
+        document = Document()
+        eq_(document.update(text), 1)
+        eq_(document.html(), org_to_html(text))
+        eq_(document.update(text), 0)
+        eq_(document.update(self.text), 4)
+        with self.assertRaises(NestingNotValidError):
+            document.update('#+BEGIN_QUOTE\n* h')
+
+    def test_document_update_newline(self):
+        document = Document(default_heading=2, newline='\n')
+        document.update(self.text)
+        eq_(document.html(), org_to_html(self.text, 2, '\n'))
+        document.update('\n' + self.text)
+        eq_(document.html(), org_to_html('\n' + self.text, 2, '\n'))
+
+    def test_site_rebuild(self):
+        with TemporaryDirectory() as src, TemporaryDirectory() as dest:
+            os.mkdir(os.path.join(src, 'sub'))
+            a = os.path.join(src, 'a.org')
+            b = os.path.join(src, 'sub', 'b.org')
+            for path in (a, b):
+                with open(path, 'w') as f:
+                    f.write('* title\ntext')
+            site = Site(src, dest)
+            try:
+                eq_(site.poll(), set([a, b]))
+                site.rebuild([a, b])
+                with open(os.path.join(dest, 'sub', 'b.html')) as f:
+                    eq_(f.read(), '<h1>title</h1><p>text</p>')
+                with open(a, 'w') as f:
+                    f.write('* title\ntext\n* new')
+                os.utime(a, ns=(0, 0))
+                os.remove(b)
+                eq_(site.poll(), set([a, b]))
+                results = site.rebuild([a, b])
+                eq_(results[a][0], 1)
+                ok_(not os.path.exists(os.path.join(dest, 'sub', 'b.html')))
+                with open(os.path.join(dest, 'a.html')) as f:
+                    eq_(f.read(), '<h1>title</h1><p>text</p><h1>new</h1>')
+                eq_(site.poll(), set())
+            finally:
+                site.close()
 
 
 if __name__ == '__main__':